@@ -0,0 +1,479 @@
+"""benchmarks of the simulation hot path
+
+Times simulation steps and pair interactions per second across body
+counts, force backends and integrators, without opening a window. The
+results are printed as a table and written as json, so runs of different
+commits can be compared with --compare. --micro times the Position and
+Vector value types instead, --scaling the parallel backend over the
+number of processes and --startup the time until a headless job runs.
+"""
+
+import sys
+import json
+import math
+import time
+import os
+import timeit
+import random
+import argparse
+import platform
+import subprocess
+import numpy as np
+import simulation
+
+
+class CountingBackend():
+    """Wrap a force backend and count the pairs it was asked for.
+
+    Counted are the pairs a direct sum would need, so backends that
+    approximate are compared by the work they replace.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.pairs = 0
+
+    def __call__(self, positions, masses, out=None, targets=None):
+        count = len(masses) if targets is None else len(targets)
+        self.pairs += count * (len(masses) - 1)
+        return self.backend(positions, masses, out=out, targets=targets)
+
+
+def synthetic_planets(count, seed=0):
+    """A sun and count - 1 light bodies on circular orbits around it."""
+    rng = np.random.default_rng(seed)
+    sun_mass = 1.989e+30
+    planets = [simulation.Planet("sun", sun_mass)]
+    radii = rng.uniform(0.3, 30, count - 1) * simulation.CONSTANTS.AU
+    angles = rng.uniform(0, 2 * math.pi, count - 1)
+    speeds = np.sqrt(simulation.CONSTANTS.G * sun_mass / radii)
+    masses = rng.uniform(1e+20, 1e+25, count - 1)
+    for index in range(count - 1):
+        sin, cos = math.sin(angles[index]), math.cos(angles[index])
+        planets.append(simulation.Planet(
+            "body{}".format(index), masses[index],
+            position=(radii[index] * cos, radii[index] * sin),
+            velocity=(-speeds[index] * sin, speeds[index] * cos)))
+    return planets
+
+
+def time_steps(step, min_time):
+    """Run step until min_time passed, return steps and seconds taken."""
+    step()  # warm up, e.g. the first force evaluation of leapfrog
+    steps = 0
+    start = time.perf_counter()
+    while True:
+        step()
+        steps += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return steps, elapsed
+
+
+def bench_engine(count, backend_name, integrator_name, arguments):
+    """Time the array engine with a backend and integrator."""
+    state = simulation.SystemState.from_celestials(synthetic_planets(count))
+    backend = CountingBackend(simulation.FORCE_BACKENDS[backend_name]())
+    integrator = simulation.INTEGRATORS[integrator_name](backend)
+    try:
+        steps, elapsed = time_steps(
+            lambda: integrator.step(state, arguments.timestep),
+            arguments.min_time)
+    finally:
+        if isinstance(backend.backend, simulation.ParallelSum):
+            backend.backend.close()
+    pairs = backend.pairs * steps / (steps + 1)  # without the warm up
+    if isinstance(integrator, simulation.NumbaLeapfrog) and \
+            simulation.NumbaSum.available:
+        pairs = steps * count * (count - 1)  # does not use the backend
+    return steps / elapsed, pairs / elapsed
+
+
+def bench_objects(count, arguments, pairwise=False):
+    """Time the per object Celestial.interact/update reference path.
+
+    With pairwise, the forces come from interact_pairwise instead.
+    """
+    celestials = synthetic_planets(count)
+
+    def step():
+        if pairwise:
+            simulation.interact_pairwise(celestials)
+        else:
+            for celestial in celestials:
+                celestial.interact(celestials)
+        for celestial in celestials:
+            celestial.update(arguments.timestep)
+
+    steps, elapsed = time_steps(step, arguments.min_time)
+    return steps / elapsed, steps * count * (count - 1) / elapsed
+
+
+def count_positions(function):
+    """Number of Position (and Vector) objects created by function()."""
+    created = [0]
+    original = simulation.Position.__init__
+
+    def counting_init(self, *args, **kwargs):
+        created[0] += 1
+        original(self, *args, **kwargs)
+
+    simulation.Position.__init__ = counting_init
+    try:
+        function()
+    finally:
+        simulation.Position.__init__ = original
+    return created[0]
+
+
+def micro_benchmarks(arguments):
+    """Compare operator based and in place use of the value types."""
+    body = simulation.Planet("earth", 5.972e+24, (1.496e+11, 0),
+                             (0, 2.978e+4))
+    body.pending_force_update = simulation.Force(-3.5e+22, 1e+10)
+    timestep = arguments.timestep
+
+    def update_operators():
+        body.velocity = (body.velocity +
+                         body.pending_force_update / body.mass * timestep)
+        body.position = body.position + body.velocity * timestep
+
+    def update_inplace():
+        body.velocity.add_scaled(body.pending_force_update,
+                                 timestep / body.mass)
+        body.position.add_scaled(body.velocity, timestep)
+
+    def vector_eager():
+        vector = simulation.Vector(3.0, 4.0)
+        return vector.strength, vector.direction
+
+    def vector_lazy():
+        return simulation.Vector(3.0, 4.0)
+
+    cases = [("update, operators", update_operators),
+             ("update, in place", update_inplace),
+             ("Vector, eager strength", vector_eager),
+             ("Vector, lazy strength", vector_lazy)]
+    celestials = synthetic_planets(11)
+    force = simulation.Force(1e+10, 1e+10)
+
+    def update_celestials():
+        for celestial in celestials:
+            celestial.pending_force_update = force
+            celestial.update(timestep)
+
+    cases.append(("Celestial.update x11", update_celestials))
+    results = []
+    for name, function in cases:
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        seconds = min(timer.repeat(3, number)) / number
+        results.append({"case": name, "microseconds": seconds * 1e+6,
+                        "positions_created": count_positions(function)})
+        print("{:<24} {:>10.3f} us {:>4} objects".format(
+            name, results[-1]["microseconds"],
+            results[-1]["positions_created"]))
+    return results
+
+
+def scaling(arguments):
+    """Time the parallel backend with 1, 2, 4, ... processes.
+
+    Efficiency is the speedup over one process divided by the processes,
+    1 meaning perfect scaling.
+    """
+    count = arguments.counts[-1]
+    state = simulation.SystemState.from_celestials(synthetic_planets(count))
+    results = []
+    print("{:>7} {:>8} {:>12} {:>8} {:>10}".format(
+        "bodies", "workers", "evals/s", "speedup", "efficiency"))
+    for workers in sorted({min(2 ** power, arguments.max_workers)
+                           for power in range(
+                               arguments.max_workers.bit_length() + 1)}):
+        backend = simulation.ParallelSum(workers)
+        try:
+            steps, elapsed = time_steps(
+                lambda: backend(state.positions, state.masses,
+                                out=state.accelerations),
+                arguments.min_time)
+        finally:
+            backend.close()
+        rate = steps / elapsed
+        speedup = rate / results[0]["evaluations_per_second"] if results \
+            else 1.0
+        results.append({"bodies": count, "workers": workers,
+                        "evaluations_per_second": rate,
+                        "speedup": speedup,
+                        "efficiency": speedup / workers})
+        print("{:>7} {:>8} {:>12.4g} {:>8.2f} {:>10.0%}".format(
+            count, workers, rate, speedup, speedup / workers))
+        sys.stdout.flush()
+    return results
+
+
+def verify_trajectories(arguments):
+    """Compare trajectories of the engine against the reference path.
+
+    Every backend with the euler integrator has to follow the per object
+    Celestial.interact/update path, and the numba leapfrog the numpy one.
+    Return whether all of them stayed within their tolerance.
+    """
+    steps = arguments.verify_steps
+    count = arguments.verify_count
+
+    def run_engine(backend, integrator):
+        state = simulation.SystemState.from_celestials(
+            synthetic_planets(count))
+        backend = simulation.FORCE_BACKENDS[backend]()
+        integrator = simulation.INTEGRATORS[integrator](backend)
+        try:
+            for _ in range(steps):
+                integrator.step(state, arguments.timestep)
+        finally:
+            if isinstance(backend, simulation.ParallelSum):
+                backend.close()
+        return state.positions
+
+    celestials = synthetic_planets(count)
+    for _ in range(steps):
+        for celestial in celestials:
+            celestial.interact(celestials)
+        for celestial in celestials:
+            celestial.update(arguments.timestep)
+    reference = np.array([celestial.position.x_y
+                          for celestial in celestials])
+    comparisons = [
+        (backend, "euler", reference,
+         1e-4 if backend == simulation.BarnesHut.name else 1e-9)
+        for backend in sorted(simulation.FORCE_BACKENDS)]
+    comparisons.append((simulation.NumbaSum.name,
+                        simulation.NumbaLeapfrog.name,
+                        run_engine(simulation.PairwiseSum.name,
+                                   simulation.Leapfrog.name), 1e-9))
+    passed = True
+    for backend, integrator, expected, tolerance in comparisons:
+        deviation = (np.abs(run_engine(backend, integrator) - expected).max()
+                     / np.abs(expected).max())
+        passed &= bool(deviation <= tolerance)
+        print("{:>10} {:>14} deviation {:.2e} {}".format(
+            backend, integrator, deviation,
+            "ok" if deviation <= tolerance else "FAILED"))
+    if not simulation.NumbaSum.available:
+        print("numba is not installed, its backend fell back to pairwise")
+    return passed
+
+
+HEAVY_MODULES = ("pygame", "colour", "tqdm", "numba")
+
+
+def import_times(script):
+    """Run script in a fresh interpreter with -X importtime.
+
+    Return the cumulative microseconds of the top level imports and the
+    ones they make directly, and the heavy modules that were really loaded,
+    not just set up to be.
+    """
+    check = ("import sys\n{}\nimport json\nprint(json.dumps([name for name "
+             "in {!r} if type(sys.modules.get(name)).__name__ == 'module']))"
+             ).format(script, HEAVY_MODULES)
+    finished = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        cwd=os.path.dirname(os.path.abspath(simulation.__file__)),
+        capture_output=True, text=True, check=True)
+    times = {}
+    for line in finished.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2  # indented by two
+        if depth <= 1:
+            times[name.strip()] = int(cumulative)
+    return times, json.loads(finished.stdout.splitlines()[-1])
+
+
+def startup(arguments):
+    """Time importing simulation and a short headless run.
+
+    Both happen in fresh interpreters, the way cluster jobs start. The
+    median of --startup-runs is reported.
+    """
+    imports = []
+    for _ in range(arguments.startup_runs):
+        times, loaded = import_times("import simulation")
+        imports.append(times)
+    import_ms = np.median([times["simulation"] for times in imports]) / 1e3
+    slowest = sorted(imports[-1].items(), key=lambda item: -item[1])[1:9]
+    runs = []
+    for _ in range(arguments.startup_runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, simulation.__file__, "--hide",
+                        "-d", "1"], capture_output=True, check=True)
+        runs.append(time.perf_counter() - started)
+    run_ms = np.median(runs) * 1e3
+    print("import simulation {:>8.1f} ms".format(import_ms))
+    print("headless run      {:>8.1f} ms".format(run_ms))
+    print("heavy modules loaded on import: {}".format(
+        ", ".join(loaded) or "none"))
+    print("slowest imports of simulation:")
+    for name, microseconds in slowest:
+        print("  {:<32} {:>8.1f} ms".format(name, microseconds / 1e3))
+    passed = not loaded
+    if arguments.max_startup is not None and import_ms > arguments.max_startup:
+        print("import took longer than {} ms".format(arguments.max_startup))
+        passed = False
+    return {"import_ms": import_ms, "headless_run_ms": run_ms,
+            "loaded": loaded, "passed": passed,
+            "slowest": {name: microseconds / 1e3
+                        for name, microseconds in slowest}}
+
+
+def environment():
+    """Describe where the benchmark ran."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run_benchmarks(arguments):
+    """Run all selected combinations and collect their results."""
+    results = []
+    for count in arguments.counts:
+        cases = [(backend, integrator) for backend in arguments.backends
+                 for integrator in arguments.integrators]
+        if count <= arguments.max_objects:
+            cases[:0] = [("objects", "euler"), ("objpairs", "euler")]
+        for backend, integrator in cases:
+            random.seed(0)
+            if backend in ("objects", "objpairs"):
+                steps, pairs = bench_objects(count, arguments,
+                                             backend == "objpairs")
+            else:
+                steps, pairs = bench_engine(count, backend, integrator,
+                                            arguments)
+            results.append({"bodies": count, "backend": backend,
+                            "integrator": integrator,
+                            "steps_per_second": steps,
+                            "pairs_per_second": pairs})
+            print_row(results[-1], arguments.reference)
+            sys.stdout.flush()
+    return results
+
+
+def case_key(result):
+    """Identify a benchmark case across runs."""
+    return result["bodies"], result["backend"], result["integrator"]
+
+
+def print_header():
+    """Print the head of the result table."""
+    print("{:>7} {:>10} {:>14} {:>12} {:>12} {:>8}".format(
+        "bodies", "backend", "integrator", "steps/s", "pairs/s", "change"))
+
+
+def print_row(result, reference=None):
+    """Print one result, with its speed relative to a reference run."""
+    change = ""
+    if reference and case_key(result) in reference:
+        change = "{:+.0%}".format(
+            result["steps_per_second"] /
+            reference[case_key(result)]["steps_per_second"] - 1)
+    print("{:>7} {:>10} {:>14} {:>12.4g} {:>12.4g} {:>8}".format(
+        result["bodies"], result["backend"], result["integrator"],
+        result["steps_per_second"], result["pairs_per_second"], change))
+
+
+def parse_args():
+    """Use argparse."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--counts", type=int, nargs="+",
+                        default=[11, 100, 1000, 10000], help="Numbers of "
+                        "bodies to benchmark.")
+    parser.add_argument("-b", "--backends", nargs="+",
+                        choices=sorted(simulation.FORCE_BACKENDS),
+                        default=sorted(simulation.FORCE_BACKENDS))
+    parser.add_argument("-i", "--integrators", nargs="+",
+                        choices=sorted(simulation.INTEGRATORS),
+                        default=sorted(simulation.INTEGRATORS))
+    parser.add_argument("--max-objects", type=int, default=100, help=""
+                        "Largest number of bodies to also time the per "
+                        "object Celestial.interact and interact_pairwise "
+                        "paths with.")
+    parser.add_argument("-t", "--timestep", type=float, default=60*60,
+                        help="Seconds per simulation step.")
+    parser.add_argument("--min-time", type=float, default=1.0, help=""
+                        "Seconds to repeat each case for.")
+    parser.add_argument("-o", "--output", default="benchmark_out.json",
+                        help="File to write the results to as json.")
+    parser.add_argument("--compare", default=None, help="Results of an "
+                        "earlier run to show the change against.")
+    parser.add_argument("--micro", action="store_true", help="Only run the "
+                        "micro benchmarks of the Position and Vector types.")
+    parser.add_argument("--scaling", action="store_true", help="Only time "
+                        "the parallel backend for the last of --counts "
+                        "bodies with 1, 2, 4, ... processes.")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count(),
+                        help="Most processes tried by --scaling.")
+    parser.add_argument("--verify", action="store_true", help="Instead of "
+                        "timing, check that all backends follow the "
+                        "trajectories of the reference Celestial.interact "
+                        "path.")
+    parser.add_argument("--verify-steps", type=int, default=500, help=""
+                        "Number of steps compared by --verify.")
+    parser.add_argument("--verify-count", type=int, default=100, help=""
+                        "Number of bodies compared by --verify. Below {} "
+                        "the pairwise backend does not use its own "
+                        "kernel.".format(simulation.PairwiseSum.min_bodies))
+    parser.add_argument("--startup", action="store_true", help="Only time "
+                        "importing simulation and a one step headless run. "
+                        "Fails if the display stack, colour, tqdm or numba "
+                        "are imported by that, or the import takes longer "
+                        "than --max-startup.")
+    parser.add_argument("--startup-runs", type=int, default=5, help=""
+                        "Fresh interpreters timed by --startup.")
+    parser.add_argument("--max-startup", type=float, default=None,
+                        help="Most milliseconds the import may take in "
+                        "--startup.")
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks."""
+    arguments = parse_args()
+    arguments.reference = None
+    if arguments.compare is not None:
+        with open(arguments.compare) as json_file:
+            arguments.reference = {
+                case_key(result): result
+                for result in json.load(json_file)["results"]}
+    if arguments.verify:
+        sys.exit(0 if verify_trajectories(arguments) else 1)
+    if arguments.micro:
+        report = {"micro": micro_benchmarks(arguments)}
+    elif arguments.scaling:
+        report = {"scaling": scaling(arguments)}
+    elif arguments.startup:
+        report = {"startup": startup(arguments)}
+    else:
+        print_header()
+        report = {"results": run_benchmarks(arguments)}
+    with open(arguments.output, "w") as json_file:
+        json.dump({"environment": environment(), **report}, json_file,
+                  indent=1)
+    if not report.get("startup", {}).get("passed", True):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,72 @@
 """sun earth simulation"""
 
-import io
+import os
+import sys
 import csv
+import json
+import copy
 import math
+import pickle
+import shutil
+import struct
+import time
 import types
+import queue
 import random
 import argparse
 import operator
-import tqdm
-import colour
-import pygame
+import functools
+import atexit
+import weakref
+import warnings
+import tempfile
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+import concurrent.futures
+import multiprocessing.shared_memory
+import importlib.util
+import numpy as np
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+
+class MissingModule():
+    """Stands in for a module that is not installed, until it is used."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        raise ImportError("{} is needed for this, but it is not "
+                          "installed".format(self.name))
+
+
+def lazy_import(name):
+    """A module that is only really imported once one of its attributes is
+    used, so headless runs never load the display stack."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pstats = lazy_import("pstats")
+cProfile = lazy_import("cProfile")
+tqdm = lazy_import("tqdm")
+colour = lazy_import("colour")
+pygame = lazy_import("pygame")
+numba = None  # imported by load_numba once a numba backend is used
 
 # Force = collections.namedtuple("Force", ("x", "y"))
 # Position = collections.namedtuple("Position", ("x", "y"))
@@ -19,6 +76,7 @@ CONSTANTS = types.SimpleNamespace(
     G=6.672e-11,
     AU=1.496e+11
 )
+CONSTANTS_G = CONSTANTS.G  # as a global, numba can compile it in
 
 FACTORS = types.SimpleNamespace(
     E=1e+18, P=1e+15, T=1e+12,
@@ -32,6 +90,9 @@ FACTORS = types.SimpleNamespace(
 
 class Position():
     """A position or position-like thing."""
+
+    __slots__ = ("x", "y")
+
     def __init__(self, x_or_tuple=None, y=None, x=None):
         if x_or_tuple is x is y is None:
             self.x = self.y = 0  # pylint: disable=invalid-name
@@ -61,6 +122,38 @@ class Position():
     def __pow__(self, other):
         return self._calculate(other, operator.pow)
 
+    def __iadd__(self, other):
+        return self._calculate_inplace(other, operator.add)
+
+    def __isub__(self, other):
+        return self._calculate_inplace(other, operator.sub)
+
+    def __imul__(self, other):
+        return self._calculate_inplace(other, operator.mul)
+
+    def __itruediv__(self, other):
+        return self._calculate_inplace(other, operator.truediv)
+
+    def add_scaled(self, other, factor):
+        """Add other times factor in place, without a temporary object."""
+        self.x += other.x * factor
+        self.y += other.y * factor
+        return self
+
+    def _calculate_inplace(self, other, operation):
+        if isinstance(other, Position):
+            self.x = operation(self.x, other.x)
+            self.y = operation(self.y, other.y)
+        elif isinstance(other, (int, float)):
+            self.x = operation(self.x, other)
+            self.y = operation(self.y, other)
+        elif isinstance(other, (tuple, list)):
+            self.x = operation(self.x, other[0])
+            self.y = operation(self.y, other[1])
+        else:
+            raise NotImplementedError
+        return self
+
     def _calculate(self, other, operation):
         if isinstance(other, Position):
             return Position(operation(self.x, other.x),
@@ -94,21 +187,48 @@ class Position():
 
 
 class Vector(Position):
-    """Like a position, but has direction and strength/speed"""
+    """Like a position, but has direction and strength/speed
+
+    Strength and direction are only calculated when they are asked for.
+    """
+
+    __slots__ = ("_strength", "_direction")
+
     def __init__(self, x_or_tuple=None, y=None,  # pylint: disable=R0913
                  x=None, strength=None, direction=None):
         if strength is None and direction is None:
             super().__init__(x_or_tuple, y, x)
-            self.strength = math.sqrt(self.x ** 2 + self.y ** 2)
-            self.direction = math.atan2(self.x, self.y)
+            self._strength = self._direction = None
         else:
-            self.strength = strength
-            self.direction = direction
+            self._strength = strength
+            self._direction = direction
             xpart = math.sin(self.direction)
             ypart = math.cos(self.direction)
             super().__init__(x=xpart * strength, y=ypart * strength)
         # print(self.direction)
 
+    @property
+    def strength(self):
+        """Length of the vector."""
+        if self._strength is None:
+            self._strength = math.sqrt(self.x ** 2 + self.y ** 2)
+        return self._strength
+
+    @property
+    def direction(self):
+        """Angle of the vector in radiant, clockwise from the y axis."""
+        if self._direction is None:
+            self._direction = math.atan2(self.x, self.y)
+        return self._direction
+
+    def _calculate_inplace(self, other, operation):
+        self._strength = self._direction = None
+        return super()._calculate_inplace(other, operation)
+
+    def add_scaled(self, other, factor):
+        self._strength = self._direction = None
+        return super().add_scaled(other, factor)
+
     def translate_direction(self):
         """Translate radiant to cardinal direction."""
         xpart = math.sin(self.direction)
@@ -136,6 +256,16 @@ class Canvas():
         # self.offset = Position(*[i / 2 for i in screen.get_size()])
         self.focus = Position(0, 0)
         self.offset = Position(-600, -400)
+        self.background = (20, 20, 20)
+        self.style = None
+        self.particle_style = None
+        self.dirty = None
+        self.max_dirty = 500
+        self.trails = None
+        self.trail_length = 0
+        self.trail_every = 1
+        self.overlay = []
+        self.font = None
 
     # @property
     # def offset(self):
@@ -155,6 +285,7 @@ class Canvas():
         current_zoom = self.scale_factor
         self.scale_factor = current_zoom + step / 100 * current_zoom
         # self.scale_factor = max(min(self.scale_factor + step, 1000000), 5)
+        self.invalidate()
 
     # def move_offset(self, pos_x, pos_y):
     #     """move the plot window around"""
@@ -171,6 +302,17 @@ class Canvas():
         pos_x *= factor
         pos_y *= factor
         self.focus += (pos_x, pos_y)
+        self.invalidate()
+
+    def follow(self, position):
+        """Keep the window centered on a moving position."""
+        self.focus = position
+        self.invalidate()
+
+    def invalidate(self):
+        """The view changed, cached drawings are no longer in place."""
+        if self.trails is not None:
+            self.trails.invalidate()
 
     def is_visible(self, position, size=0):
         """Determine whether a thing would be visible."""
@@ -200,29 +342,330 @@ class Canvas():
     def place_object(self, thing):
         """Draw an object on the screen."""
         color = [i * 255 for i in thing.color.rgb]
-        size = (20, 20)
-        if thing.name == "luna":
-            size = (5, 5)
+        size = (thing.size, thing.size)
         if self.is_visible(thing.position, max(size)):
             position = self.get_position(thing.position, size)
             pygame.draw.ellipse(self.screen, color, (position, size))
 
+    def to_screen(self, positions):
+        """Convert an array of positions in space to screen coordinates."""
+        screen = (positions - self.focus.x_y) * self.scale
+        screen[:, 0] -= self.offset.x
+        screen[:, 1] *= -1
+        screen[:, 1] -= self.offset.y
+        return screen
+
+    def draw(self, state):
+        """Draw all bodies of the state and update the display.
+
+        Off screen bodies are culled all at once. While few bodies are
+        visible, only the rectangles they were and are drawn at are erased
+        and updated, otherwise the whole screen. Bodies of at most 2 pixels
+        are set directly as single pixels. With trails, they are laid
+        under the bodies in place of the background. Test particles are
+        single pixels below both, and always update the whole screen.
+        """
+        if self.style is None or len(self.style.sizes) != len(state):
+            self.style = BodyStyle.from_bodies(state.bodies)
+            self.dirty = None
+        if self.trail_length > 1:
+            if self.trails is None or self.trails.bodies != len(state):
+                self.trails = Trails(len(state), self.trail_length,
+                                     self.trail_every)
+            self.trails.push(state.positions)
+        centers = self.to_screen(state.positions)
+        half = self.style.sizes / 2
+        width, height = self.screen.get_size()
+        visible = np.flatnonzero(
+            (centers[:, 0] + half >= 0) & (centers[:, 0] - half < width) &
+            (centers[:, 1] + half >= 0) & (centers[:, 1] - half < height))
+        full = (self.dirty is None or len(visible) > self.max_dirty or
+                self.trails is not None or state.particles is not None)
+        if self.trails is not None:
+            self.screen.blit(self.trails.render(self), (0, 0))
+        elif full:
+            self.screen.fill(self.background)
+        else:
+            for rect in self.dirty:
+                self.screen.fill(self.background, rect)
+        if state.particles is not None:
+            self.draw_particles(state.particles)
+
+        small = self.style.sizes[visible] <= 2
+        rects = []
+        corners = (centers[visible] - half[visible, np.newaxis]).astype(int)
+        for index, corner in zip(visible[~small], corners[~small]):
+            rect = pygame.Rect(corner.tolist(), (self.style.sizes[index],) * 2)
+            pygame.draw.ellipse(self.screen, self.style.color(index), rect)
+            rects.append(rect)
+        if small.any():
+            points = np.clip(centers[visible[small]].astype(int), 0,
+                             (width - 1, height - 1))
+            pixels = pygame.surfarray.pixels2d(self.screen)
+            pixels[points[:, 0], points[:, 1]] = self.style.mapped(
+                self.screen)[visible[small]]
+            del pixels  # unlocks the screen
+            rects.extend(pygame.Rect(point.tolist(), (1, 1))
+                         for point in points)
+        rects.extend(self.draw_overlay())
+
+        if full:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.dirty + rects)
+        self.dirty = rects
+
+    def draw_particles(self, particles):
+        """Set the visible test particles as single pixels."""
+        if (self.particle_style is None or
+                len(self.particle_style.sizes) != len(particles)):
+            self.particle_style = BodyStyle.from_bodies(particles.bodies)
+        points = self.to_screen(particles.positions)
+        width, height = self.screen.get_size()
+        visible = np.flatnonzero(
+            (points[:, 0] >= 0) & (points[:, 0] < width) &
+            (points[:, 1] >= 0) & (points[:, 1] < height))
+        points = points[visible].astype(int)
+        pixels = pygame.surfarray.pixels2d(self.screen)
+        pixels[points[:, 0], points[:, 1]] = self.particle_style.mapped(
+            self.screen)[visible]
+        del pixels  # unlocks the screen
+
+    def draw_overlay(self):
+        """Write the overlay lines in the top left corner."""
+        if not self.overlay:
+            return []
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        rects = []
+        for number, line in enumerate(self.overlay):
+            text = self.font.render(line, True, (200, 200, 200))
+            rects.append(self.screen.blit(text, (8, 8 + 18 * number)))
+        return rects
+
+
+class Trails():
+    """Recent positions of every body, drawn as lines behind them.
+
+    The positions in space are kept in a ring buffer of fixed ``length``,
+    taking every ``every``-th new frame, so memory does not grow with the
+    run. The lines are drawn onto a cached surface: new samples only add
+    their segment, the surface is redrawn as a whole when the view changed
+    or once a quarter of the buffer was replaced, to drop the oldest part.
+    """
+
+    def __init__(self, bodies, length, every=1):
+        self.buffer = np.empty((bodies, length, 2))
+        self.length = length
+        self.every = every
+        self.head = 0  # next slot to write
+        self.count = 0
+        self.frames = 0
+        self.fresh = 0  # samples not on the surface yet
+        self.stale = 0  # samples since the surface was redrawn
+        self.surface = None
+
+    @property
+    def bodies(self):
+        """Number of bodies with a trail."""
+        return len(self.buffer)
+
+    def push(self, positions):
+        """Offer the positions of a frame, repeated frames are ignored."""
+        last = self.buffer[:, self.head - 1]
+        if self.count and np.array_equal(last, positions, equal_nan=True):
+            return
+        self.frames += 1
+        if (self.frames - 1) % self.every:
+            return
+        self.buffer[:, self.head] = positions
+        self.head = (self.head + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+        self.fresh += 1
+        self.stale += 1
+
+    def clear(self):
+        """Forget all trails, e.g. after jumping in time."""
+        self.head = self.count = self.frames = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Redraw the cached surface before it is used next."""
+        self.surface = None
+
+    def recent(self, samples):
+        """The last samples of all trails, oldest first."""
+        slots = (self.head - samples + np.arange(samples)) % self.length
+        return self.buffer[:, slots]
+
+    def render(self, canvas):
+        """The trail surface for the canvas, updated as needed."""
+        if self.surface is None or self.stale > self.length // 4:
+            self.surface = pygame.Surface(canvas.screen.get_size())
+            self.surface.fill(canvas.background)
+            samples = self.count
+            self.stale = 0
+        else:
+            samples = min(self.fresh + 1, self.count)
+        if samples >= 2:
+            self.draw(canvas, self.recent(samples))
+        self.fresh = 0
+        return self.surface
+
+    def draw(self, canvas, points):
+        """Draw lines through the points of each body onto the surface.
+
+        Points that are not finite, like those of merged bodies, break the
+        line.
+        """
+        shape = points.shape
+        finite = np.isfinite(points).all(axis=-1)
+        points = canvas.to_screen(points.reshape(-1, 2)).reshape(shape)
+        points = np.clip(np.nan_to_num(points), -32000, 32000).astype(int)
+        dimmed = [[value // 2 for value in color]
+                  for color in canvas.style.palette]
+        for shade, line, kept in zip(canvas.style.shades, points, finite):
+            breaks = np.flatnonzero(kept[1:] != kept[:-1]) + 1
+            for part, valid in zip(np.split(line, breaks),
+                                   np.split(kept, breaks)):
+                if valid[0] and len(part) >= 2:
+                    pygame.draw.lines(self.surface, dimmed[shade], False,
+                                      part.tolist())
+
+
+class BodyStyle():
+    """Colors and pixel sizes of bodies, worked out once for drawing.
+
+    The bodies share the colors of a small ``palette``, ``shades`` holds
+    the palette entry of every body.
+    """
+
+    def __init__(self, palette, shades, sizes):
+        self.palette = [tuple(int(value) for value in color)
+                        for color in palette]
+        self.shades = np.asarray(shades, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.pixels = None
+
+    @classmethod
+    def from_bodies(cls, bodies):
+        """Take the style from the color and size of each body."""
+        if isinstance(bodies, BodyList):
+            return cls([color.rgb_dec() for color in bodies.palette],
+                       bodies.shades, bodies.sizes)
+        palette = {}
+        shades = [palette.setdefault(body.color.rgb_dec(), len(palette))
+                  for body in bodies]
+        return cls(list(palette), shades, [body.size for body in bodies])
+
+    def color(self, index):
+        """Color of a body."""
+        return self.palette[self.shades[index]]
+
+    def mapped(self, surface):
+        """Colors as pixel values of the surface, for the pixel array."""
+        if self.pixels is None:
+            self.pixels = np.array([surface.map_rgb(color)
+                                    for color in self.palette])[self.shades]
+        return self.pixels
+
+
+class MyColor():
+    """Color by name or hex, only parsed by colour once it is needed."""
+
+    __slots__ = ("text", "_color")
+
+    def __init__(self, color="black"):
+        self.text = color.text if isinstance(color, MyColor) else color
+        self._color = None
+
+    def __repr__(self):
+        return "MyColor({!r})".format(self.text)
+
+    @property
+    def color(self):
+        """The parsed colour.Color."""
+        if self._color is None:
+            self._color = colour.Color(self.text)
+        return self._color
+
+    @property
+    def rgb(self):
+        """Red, green and blue between 0 and 1."""
+        return self.color.rgb
+
+    @property
+    def hex_l(self):
+        """Long hex notation like #ff0000."""
+        return self.color.hex_l
 
-class MyColor(colour.Color):
-    """Subclass for better rgb out"""
     def rgb_dec(self):
         """Decimal rgb values"""
         return tuple([i * 255 for i in self.rgb])
 
 
+class StateField():
+    """Attribute of a body that lives in a SystemState once attached.
+
+    Until the body is attached the value is stored on the body itself, so
+    planets can still be built and positioned one by one.
+    """
+    def __init__(self, array, wrapper, default=None):
+        self.array = array
+        self.wrapper = wrapper
+        self.default = default
+        self.private = None
+
+    def __set_name__(self, owner, name):
+        self.private = "_" + name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        if instance.state is None:
+            if self.private not in instance.__dict__:
+                return copy.copy(self.default)
+            return instance.__dict__[self.private]
+        value = getattr(instance.state, self.array)[instance.index]
+        return self.wrapper(value)
+
+    def __set__(self, instance, value):
+        if instance.state is None:
+            instance.__dict__[self.private] = value
+        else:
+            getattr(instance.state, self.array)[instance.index] = tuple(value)
+            instance.state.forces_current = False
+
+
+def _as_position(value):
+    return Position(float(value[0]), float(value[1]))
+
+
+def _as_direction(value):
+    return Direction(float(value[0]), float(value[1]))
+
+
+class ScalarStateField(StateField):
+    """StateField for a single number like the mass."""
+    def __set__(self, instance, value):
+        if instance.state is None:
+            instance.__dict__[self.private] = value
+        else:
+            getattr(instance.state, self.array)[instance.index] = value
+            instance.state.forces_current = False
+
+
 class Celestial():
     """Celestial Body"""
 
     direction = Direction(None, None)
-    position = Position(None, None)
+    position = StateField("positions", _as_position, Position(None, None))
     force = Force(None, None)
-    mass = None
-    velocity = Direction(None, None)
+    mass = ScalarStateField("masses", float)
+    velocity = StateField("velocities", _as_direction, Direction(None, None))
+    state = None
+    index = None
+    size = 20  # pixel on screen
     pending_force_update = None
     turtle = None
     name = None
@@ -263,7 +706,8 @@ class Celestial():
 
     def ekin(self):
         """Get kinetic energy"""
-        return 0.5 * self.mass * self.velocity ** 2
+        return 0.5 * self.mass * (self.velocity.x ** 2 +
+                                  self.velocity.y ** 2)
 
     def interact(self, others):
         """Interact with a list of others"""
@@ -298,24 +742,65 @@ class Celestial():
         # # body.goto(body.px*SCALE, body.py*SCALE)
         # # body.dot(3)
 
-        self.velocity += self.pending_force_update / self.mass * timestep
-        self.position += self.velocity * timestep
+        velocity = self.velocity
+        velocity.add_scaled(self.pending_force_update, timestep / self.mass)
+        position = self.position
+        position.add_scaled(velocity, timestep)
+        self.velocity = velocity
+        self.position = position
         self.pending_force_update = None
 
+    def attach(self, state, index):
+        """Move the body's values into a SystemState and view them there."""
+        position, velocity, mass = self.position, self.velocity, self.mass
+        self.state = None
+        self.index = index
+        state.masses[index] = mass
+        state.positions[index] = tuple(position)
+        state.velocities[index] = tuple(velocity)
+        self.state = state
+
+
+def interact_pairwise(celestials):
+    """Set the pending force of all bodies, visiting each pair once.
+
+    Like calling Celestial.interact for every body, but without
+    trigonometry and applying the force of a pair to both bodies.
+    """
+    bodies = [(celestial.position.x, celestial.position.y, celestial.mass)
+              for celestial in celestials]
+    forces = [[0.0, 0.0] for _ in bodies]
+    for first, (x_first, y_first, mass_first) in enumerate(bodies):
+        force_first = forces[first]
+        for second in range(first + 1, len(bodies)):
+            x_second, y_second, mass_second = bodies[second]
+            delta_x = x_second - x_first
+            delta_y = y_second - y_first
+            dist_sq = delta_x * delta_x + delta_y * delta_y
+            factor = (CONSTANTS.G * mass_first * mass_second /
+                      (dist_sq * math.sqrt(dist_sq)))
+            force_first[0] += factor * delta_x
+            force_first[1] += factor * delta_y
+            forces[second][0] -= factor * delta_x
+            forces[second][1] -= factor * delta_y
+    for celestial, (force_x, force_y) in zip(celestials, forces):
+        celestial.pending_force_update = Force(force_x, force_y)
+
 
 class Planet(Celestial):
     """Planet!"""
 
     def __init__(self, name, mass, position=(0, 0),
-                 velocity=(0, 0), color="black"):
+                 velocity=(0, 0), color="black", size=20):
         # pylint: disable=too-many-arguments
         self.name = name
+        self.size = size
         self.mass = mass  # kilogramm
         self.position = Position(*position)
         # self.distance = 1.496e+11  # meter
         # self.velocity = velocity  # meter pro sekunde = 108000 kmh
         self.velocity = Position(*velocity)
-        self.color = color
+        self.color = MyColor(color)
         # myturtle = turtle.Turtle()
         # myturtle.penup()
         # myturtle.hideturtle()
@@ -338,6 +823,2061 @@ class Sun(Celestial):
         self.mass = 1.989 * 10**30  # kilogramm
 
 
+class SystemState():
+    """All bodies of a simulation as a structure of arrays.
+
+    Masses, positions and velocities are kept in contiguous arrays so the
+    forces of all pairs can be computed in one batched pass. The Planet
+    objects in ``bodies`` are views into these arrays. Massless
+    ``particles`` are carried along in their own arrays.
+    """
+
+    def __init__(self, masses, positions, velocities, bodies=None):
+        self.masses = np.array(masses, dtype=float)
+        self.positions = np.array(positions, dtype=float).reshape(-1, 2)
+        self.velocities = np.array(velocities, dtype=float).reshape(-1, 2)
+        self.accelerations = np.zeros_like(self.positions)
+        self.forces_current = False
+        self.potentials = None  # filled by force passes while not None
+        self.bodies = [] if bodies is None else bodies
+        self.particles = None  # TestParticles feeling only these bodies
+
+    @classmethod
+    def from_celestials(cls, celestials):
+        """Create the state from a list of bodies and attach them to it."""
+        size = len(celestials)
+        state = cls(np.zeros(size), np.zeros((size, 2)), np.zeros((size, 2)))
+        for index, celestial in enumerate(celestials):
+            celestial.attach(state, index)
+        state.bodies = celestials
+        return state
+
+    @classmethod
+    def from_arrays(cls, masses, positions, velocities, names, colors,
+                    sizes):
+        """Create the state directly from arrays, with lazy Planet views."""
+        # pylint: disable=too-many-arguments
+        state = cls(masses, positions, velocities)
+        state.bodies = BodyList(state, names, colors, sizes)
+        return state
+
+    def __len__(self):
+        return len(self.masses)
+
+    def describe(self, indices=None):
+        """Names, colors (as hex) and sizes of all or the given bodies."""
+        if isinstance(self.bodies, BodyList):
+            return self.bodies.describe(indices)
+        bodies = (self.bodies if indices is None else
+                  [self.bodies[index] for index in indices])
+        return {"names": [body.name for body in bodies],
+                "colors": [body.color.hex_l for body in bodies],
+                "sizes": [body.size for body in bodies]}
+
+    def copy(self):
+        """Independent copy of the state, with its own Planet views."""
+        state = SystemState.from_arrays(self.masses, self.positions,
+                                        self.velocities, **self.describe())
+        if self.particles is not None:
+            state.particles = self.particles.copy()
+        return state
+
+    def remove(self, indices):
+        """Drop the given bodies, e.g. after they merged into others.
+
+        Returns the new index of every old body, -1 for the removed ones.
+        ``bodies`` is replaced rather than changed, so holders of the old
+        one keep a consistent description.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        keep[indices] = False
+        remap = np.full(len(self), -1)
+        remap[keep] = np.arange(np.count_nonzero(keep))
+        self.masses = self.masses[keep]
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.accelerations = self.accelerations[keep]
+        self.forces_current = False
+        if self.potentials is not None:
+            self.potentials = np.full(len(self), np.nan)
+        if isinstance(self.bodies, BodyList):
+            self.bodies = self.bodies.subset(self, keep)
+        else:
+            self.bodies = [body for body, kept in zip(self.bodies, keep)
+                           if kept]
+            for index, body in enumerate(self.bodies):
+                body.index = index
+        return remap
+
+    def kinetic_energy(self):
+        """Total kinetic energy of all bodies."""
+        return 0.5 * np.dot(self.masses,
+                            np.einsum("ij,ij->i", self.velocities,
+                                      self.velocities))
+
+    def potential_energy(self, block=256):
+        """Total gravitational potential energy of all pairs."""
+        total = 0.0
+        for start in range(0, len(self), block):
+            stop = min(start + block, len(self))
+            delta = self.positions[start:] - self.positions[start:stop,
+                                                            np.newaxis]
+            distance = np.sqrt(np.einsum("ijk,ijk->ij", delta, delta))
+            pairs = np.outer(self.masses[start:stop], self.masses[start:])
+            upper = np.triu(np.ones(pairs.shape, dtype=bool), 1)
+            total += np.sum(pairs[upper] / distance[upper])
+        return -CONSTANTS.G * total
+
+    def total_energy(self):
+        """Kinetic plus potential energy."""
+        return self.kinetic_energy() + self.potential_energy()
+
+    def index_of(self, name):
+        """Get the index of the body with the given name."""
+        if isinstance(self.bodies, BodyList):
+            if name in self.bodies.names:
+                return self.bodies.names.index(name)
+            raise KeyError(name)
+        for index, body in enumerate(self.bodies):
+            if body.name == name:
+                return index
+        raise KeyError(name)
+
+
+class BodyList():
+    """The bodies of a state built from arrays, as a sequence of Planets.
+
+    A Planet view is only created when a body is accessed, so states with
+    millions of bodies need no object per body. Colors are kept as a
+    palette of the distinct colors and the palette entry of every body.
+    """
+
+    def __init__(self, state, names, colors, sizes):
+        self.state = state
+        self.names = list(names)
+        palette = {}
+        self.shades = np.fromiter(
+            (palette.setdefault(color, len(palette)) for color in colors),
+            dtype=np.int64, count=len(self.names))
+        self.palette = [MyColor(color) for color in palette]
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.views = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[item] for item in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if index not in self.views:
+            body = Planet.__new__(Planet)
+            body.name = self.names[index]
+            body.color = self.palette[self.shades[index]]
+            body.size = int(self.sizes[index])
+            body.state, body.index = self.state, index
+            self.views[index] = body
+        return self.views[index]
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def subset(self, state, keep):
+        """New BodyList of state for the bodies where keep is true."""
+        bodies = copy.copy(self)
+        bodies.state = state
+        bodies.names = [name for name, kept in zip(self.names, keep) if kept]
+        bodies.shades = self.shades[keep]
+        bodies.sizes = self.sizes[keep]
+        bodies.views = {}
+        return bodies
+
+    def describe(self, indices=None):
+        """Names, colors (as hex) and sizes of all or the given bodies."""
+        if indices is None:
+            indices = range(len(self))
+        hexes = [color.hex_l for color in self.palette]
+        return {"names": [self.names[index] for index in indices],
+                "colors": [hexes[self.shades[index]] for index in indices],
+                "sizes": [int(self.sizes[index]) for index in indices]}
+
+
+class TestParticles():
+    """Massless bodies that only feel the gravity of the bodies of a state.
+
+    They live in their own arrays and pull on nothing, so their forces cost
+    bodies times particles instead of growing with the square of both.
+    Every step they get a kick-drift-kick around the step of the bodies,
+    whichever integrator moves those. ``bodies`` names and colors them like
+    the bodies of a state. Their forces are summed with numpy, or with numba
+    once ``compile`` was called.
+    """
+
+    def __init__(self, positions, velocities, names, colors, sizes):
+        # pylint: disable=too-many-arguments
+        self.positions = np.array(positions, dtype=float).reshape(-1, 2)
+        self.velocities = np.array(velocities, dtype=float).reshape(-1, 2)
+        self.accelerations = np.zeros_like(self.positions)
+        self.masses = np.zeros(len(self.positions))  # for the Planet views
+        self.forces_current = False
+        self.bodies = BodyList(self, names, colors, sizes)
+        self.compiled = False
+
+    def __len__(self):
+        return len(self.positions)
+
+    def describe(self, indices=None):
+        """Names, colors (as hex) and sizes of all or the given particles."""
+        return self.bodies.describe(indices)
+
+    def copy(self):
+        """Independent copy of the particles."""
+        particles = TestParticles(self.positions, self.velocities,
+                                  **self.describe())
+        particles.compiled = self.compiled
+        return particles
+
+    def compile(self):
+        """Pull with the numba kernel, if numba is installed.
+
+        Call this on the main thread, where numba has to be loaded.
+        """
+        self.compiled = load_numba() is not None
+
+    def pull(self, state):
+        """Accelerations of the particles by the bodies of state."""
+        if self.compiled:
+            _field_kernel(self.positions, state.positions, state.masses,
+                          self.accelerations)
+        else:
+            field_accelerations(self.positions, state.positions,
+                                state.masses, out=self.accelerations)
+        self.forces_current = True
+        return self.accelerations
+
+    def start(self, state, timestep):
+        """Kick and drift the particles, before the bodies are stepped."""
+        if not self.forces_current:
+            self.pull(state)
+        self.velocities += self.accelerations * (timestep / 2)
+        self.positions += self.velocities * timestep
+
+    def finish(self, state, timestep):
+        """Kick the particles by the bodies at their new positions."""
+        self.velocities += self.pull(state) * (timestep / 2)
+
+
+def direct_accelerations(positions, masses, out=None, targets=None,
+                         block=256, potential=None):
+    """Accelerations of bodies by direct summation over all pairs.
+
+    ``targets`` optionally selects the bodies to compute the acceleration
+    for, all bodies act as sources. The rows are processed in blocks, so the
+    temporaries stay at ``block * len(masses)`` instead of growing with the
+    square of the bodies. If given, ``potential`` receives the gravitational
+    potential at each target from the same distances.
+    """
+    # pylint: disable=too-many-arguments
+    if targets is None:
+        targets = np.arange(len(masses))
+    if out is None:
+        out = np.empty((len(targets), 2))
+    for start in range(0, len(targets), block):
+        rows = targets[start:start + block]
+        delta = positions[np.newaxis] - positions[rows, np.newaxis]
+        dist_sq = np.einsum("ijk,ijk->ij", delta, delta)
+        dist_sq[np.arange(len(rows)), rows] = np.inf  # no self interaction
+        if potential is None:
+            weight = dist_sq ** -1.5
+        else:
+            inverse = dist_sq ** -0.5
+            potential[start:start + len(rows)] = (
+                inverse @ masses) * -CONSTANTS.G
+            weight = inverse * inverse
+            weight *= inverse
+        weight *= masses
+        np.einsum("ij,ijk->ik", weight, delta,
+                  out=out[start:start + len(rows)])
+    out *= CONSTANTS.G
+    return out
+
+
+def pairwise_accelerations(positions, masses, out=None, block=128,
+                           potential=None):
+    """Accelerations of all bodies, visiting each unordered pair once.
+
+    The pull of a pair is calculated once and applied to both bodies in
+    opposite directions, using ``delta / r ** 3`` instead of angles. The x
+    and y coordinates are handled as separate contiguous arrays. If given,
+    ``potential`` receives the gravitational potential at every body, from
+    the ``1 / r`` of the same pairs.
+    """
+    count = len(masses)
+    if out is None:
+        out = np.empty_like(positions)
+    out[:] = 0
+    if potential is not None:
+        potential[:] = 0
+    pos_x = np.ascontiguousarray(positions[:, 0])
+    pos_y = np.ascontiguousarray(positions[:, 1])
+    for start in range(0, count, block):
+        stop = min(start + block, count)
+        delta_x = pos_x[np.newaxis, start:] - pos_x[start:stop, np.newaxis]
+        delta_y = pos_y[np.newaxis, start:] - pos_y[start:stop, np.newaxis]
+        weight = delta_x * delta_x
+        weight += delta_y * delta_y
+        # each pair only once and no self interaction
+        weight[np.tril_indices(stop - start)] = np.inf
+        if potential is None:
+            weight *= np.sqrt(weight)
+            np.divide(1.0, weight, out=weight)
+        else:
+            inverse = np.sqrt(weight)
+            np.divide(1.0, inverse, out=inverse)
+            potential[start:stop] += inverse @ masses[start:]
+            potential[start:] += masses[start:stop] @ inverse
+            weight = inverse * inverse
+            weight *= inverse
+        pulled = weight * masses[start:]
+        out[start:stop, 0] += np.einsum("ij,ij->i", pulled, delta_x)
+        out[start:stop, 1] += np.einsum("ij,ij->i", pulled, delta_y)
+        out[start:, 0] -= masses[start:stop] @ (weight * delta_x)
+        out[start:, 1] -= masses[start:stop] @ (weight * delta_y)
+    out *= CONSTANTS.G
+    if potential is not None:
+        potential *= -CONSTANTS.G
+    return out
+
+
+def field_accelerations(points, positions, masses, out=None, block=1024):
+    """Accelerations at points by the bodies, which they do not pull back.
+
+    Costs ``len(points) * len(masses)`` pairs. The points are processed in
+    blocks, so the temporaries stay at ``block * len(masses)``.
+    """
+    if out is None:
+        out = np.empty((len(points), 2))
+    for start in range(0, len(points), block):
+        delta = positions[np.newaxis] - points[start:start + block,
+                                               np.newaxis]
+        weight = np.einsum("ijk,ijk->ij", delta, delta) ** -1.5
+        weight *= masses
+        np.einsum("ij,ijk->ik", weight, delta, out=out[start:start + block])
+    out *= CONSTANTS.G
+    return out
+
+
+class DirectSum():
+    """Exact forces by summing over all pairs of bodies."""
+
+    name = "direct"
+
+    def __call__(self, positions, masses, out=None, targets=None,
+                 potential=None):
+        return direct_accelerations(positions, masses, out, targets,
+                                    potential=potential)
+
+
+class PairwiseSum():
+    """Exact forces, using that each pair pulls both bodies equally.
+
+    Only the accelerations of all bodies at once benefit from this, for a
+    subset of targets, or so few bodies that the fewer numpy calls of the
+    direct sum win, it falls back to the direct sum.
+    """
+
+    name = "pairwise"
+    min_bodies = 32
+
+    def __call__(self, positions, masses, out=None, targets=None,
+                 potential=None):
+        if targets is not None or len(masses) < self.min_bodies:
+            return direct_accelerations(positions, masses, out, targets,
+                                        potential=potential)
+        return pairwise_accelerations(positions, masses, out,
+                                      potential=potential)
+
+
+NUMBA_AVAILABLE = importlib.util.find_spec("numba") is not None
+_KERNELS = []
+_prange = range
+
+
+def _jit(function):
+    """Mark a function to be compiled by load_numba."""
+    _KERNELS.append((function.__name__, False))
+    return function
+
+
+def _jit_parallel(function):
+    """Mark a function to be compiled by load_numba, with threads."""
+    _KERNELS.append((function.__name__, True))
+    return function
+
+
+def load_numba():
+    """Import numba and compile the kernels, None without numba.
+
+    Importing numba takes longer than all the rest, so this only happens
+    once a numba backend is actually used. Its threads are started right
+    away: TBB hangs at exit if they were first started by another thread
+    than the main one, like the SimulationThread.
+    """
+    global numba, _prange  # pylint: disable=global-statement
+    if numba is None and NUMBA_AVAILABLE:
+        import numba as module  # pylint: disable=import-outside-toplevel
+        numba, _prange = module, module.prange
+        numba.get_num_threads()
+        for name, parallel in _KERNELS:  # in order, callees first
+            globals()[name] = numba.njit(cache=True, parallel=parallel)(
+                globals()[name])
+    return numba
+
+
+@_jit
+def _pair_kernel(positions, masses, out, potential):
+    """Compiled pairwise_accelerations, without any temporary arrays.
+
+    The potential is only summed up if it is not empty.
+    """
+    track = len(potential) > 0
+    out[:] = 0.0
+    potential[:] = 0.0
+    for first in range(len(masses)):
+        x_first = positions[first, 0]
+        y_first = positions[first, 1]
+        acc_x = acc_y = pot = 0.0
+        for second in range(first + 1, len(masses)):
+            delta_x = positions[second, 0] - x_first
+            delta_y = positions[second, 1] - y_first
+            dist_sq = delta_x * delta_x + delta_y * delta_y
+            inverse = 1.0 / math.sqrt(dist_sq)
+            weight = inverse * inverse * inverse
+            acc_x += masses[second] * weight * delta_x
+            acc_y += masses[second] * weight * delta_y
+            out[second, 0] -= masses[first] * weight * delta_x
+            out[second, 1] -= masses[first] * weight * delta_y
+            if track:
+                pot += masses[second] * inverse
+                potential[second] += masses[first] * inverse
+        out[first, 0] += acc_x
+        out[first, 1] += acc_y
+        if track:
+            potential[first] += pot
+    out *= CONSTANTS_G
+    potential *= -CONSTANTS_G
+
+
+@_jit_parallel
+def _target_kernel(positions, masses, targets, out, potential):
+    """Compiled direct_accelerations, the targets spread over threads.
+
+    The potential is only filled in if it is not empty.
+    """
+    track = len(potential) > 0
+    for row in _prange(len(targets)):  # pylint: disable=not-an-iterable
+        target = targets[row]
+        acc_x = acc_y = pot = 0.0
+        for other in range(len(masses)):
+            if other == target:
+                continue
+            delta_x = positions[other, 0] - positions[target, 0]
+            delta_y = positions[other, 1] - positions[target, 1]
+            dist_sq = delta_x * delta_x + delta_y * delta_y
+            inverse = 1.0 / math.sqrt(dist_sq)
+            weight = masses[other] * inverse * inverse * inverse
+            acc_x += weight * delta_x
+            acc_y += weight * delta_y
+            pot += masses[other] * inverse
+        out[row, 0] = acc_x * CONSTANTS_G
+        out[row, 1] = acc_y * CONSTANTS_G
+        if track:
+            potential[row] = -pot * CONSTANTS_G
+
+
+@_jit
+def _leapfrog_kernel(positions, velocities, masses, accelerations, timestep,
+                     steps):
+    """Compiled kick-drift-kick steps with pairwise forces.
+
+    accelerations have to be those at the current positions, they are
+    updated to the ones at the new positions.
+    """
+    for _ in range(steps):
+        velocities += accelerations * (timestep / 2)
+        positions += velocities * timestep
+        _pair_kernel(positions, masses, accelerations, np.empty(0))
+        velocities += accelerations * (timestep / 2)
+
+
+@_jit_parallel
+def _field_kernel(points, positions, masses, out):
+    """Compiled field_accelerations, the points spread over threads."""
+    for row in _prange(len(points)):  # pylint: disable=not-an-iterable
+        acc_x = acc_y = 0.0
+        for other in range(len(masses)):
+            delta_x = positions[other, 0] - points[row, 0]
+            delta_y = positions[other, 1] - points[row, 1]
+            dist_sq = delta_x * delta_x + delta_y * delta_y
+            weight = masses[other] / (dist_sq * math.sqrt(dist_sq))
+            acc_x += weight * delta_x
+            acc_y += weight * delta_y
+        out[row, 0] = acc_x * CONSTANTS_G
+        out[row, 1] = acc_y * CONSTANTS_G
+
+
+class NumbaSum():
+    """Exact forces from a numba compiled kernel.
+
+    Needs no temporary arrays at all. With ``parallel`` every thread sums
+    the forces on a part of the bodies, otherwise each pair is only visited
+    once on a single thread. Without numba this is the PairwiseSum.
+    """
+
+    name = "numba"
+    available = NUMBA_AVAILABLE
+
+    def __init__(self, parallel=None):
+        if parallel is None:
+            parallel = (self.available and
+                        load_numba().config.NUMBA_NUM_THREADS > 1)
+        load_numba()
+        self.parallel = parallel
+        self.fallback = PairwiseSum()
+
+    def __call__(self, positions, masses, out=None, targets=None,
+                 potential=None):
+        if not self.available:
+            return self.fallback(positions, masses, out, targets, potential)
+        if potential is None:
+            potential = np.empty(0)
+        if targets is None and not self.parallel:
+            if out is None:
+                out = np.empty_like(positions)
+            _pair_kernel(positions, masses, out, potential)
+            return out
+        if targets is None:
+            targets = np.arange(len(masses))
+        if out is None:
+            out = np.empty((len(targets), 2))
+        _target_kernel(positions, masses, targets, out, potential)
+        return out
+
+
+def _spread_bits(values):
+    """Insert a zero bit between each of the lower 32 bits of values."""
+    values = values.astype(np.uint64)
+    values = (values | values << 16) & 0x0000FFFF0000FFFF
+    values = (values | values << 8) & 0x00FF00FF00FF00FF
+    values = (values | values << 4) & 0x0F0F0F0F0F0F0F0F
+    values = (values | values << 2) & 0x3333333333333333
+    values = (values | values << 1) & 0x5555555555555555
+    return values
+
+
+def _ranges(starts, counts):
+    """Concatenate ``range(start, start + count)`` for all given pairs."""
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - offsets
+
+
+class QuadTree():
+    """Linear quadtree over bodies, built from sorted morton keys.
+
+    All nodes of all levels are stored in flat arrays, level after level.
+    The bodies of a node are the range ``start:end`` of the sorted bodies
+    and the children of a node are the nodes ``child_start:child_end``.
+    """
+
+    max_depth = 21
+
+    def __init__(self, positions, masses, leaf_size=8):
+        low = positions.min(axis=0)
+        size = max((positions.max(axis=0) - low).max(), 1.0) * (1 + 1e-9)
+        cells = 1 << self.max_depth
+        grid = ((positions - low) * (cells / size)).astype(np.int64)
+        np.clip(grid, 0, cells - 1, out=grid)
+        keys = _spread_bits(grid[:, 0]) | _spread_bits(grid[:, 1]) << 1
+        self.order = np.argsort(keys, kind="stable")
+        keys = keys[self.order]
+        grid = grid[self.order]
+        self.positions = positions[self.order]
+        self.masses = masses[self.order]
+        weighted = self.positions * self.masses[:, np.newaxis]
+
+        levels = []
+        for depth in range(self.max_depth + 1):
+            level_keys = keys >> np.uint64(2 * (self.max_depth - depth))
+            start = np.flatnonzero(np.concatenate(
+                ([True], level_keys[1:] != level_keys[:-1])))
+            end = np.append(start[1:], len(keys))
+            mass = np.add.reduceat(self.masses, start)
+            moment = np.add.reduceat(weighted, start)
+            center = np.add.reduceat(self.positions, start)
+            center /= (end - start)[:, np.newaxis]
+            com = np.divide(moment, mass[:, np.newaxis], out=center,
+                            where=mass[:, np.newaxis] > 0)
+            width = size / (1 << depth)
+            cell = (grid[start] >> (self.max_depth - depth)) + 0.5
+            leaf = (end - start <= leaf_size) | (depth == self.max_depth)
+            levels.append((level_keys[start], start, end, mass, com,
+                           low + cell * width, np.full(len(start), width),
+                           leaf))
+            if leaf.all():
+                break
+
+        offsets = np.cumsum([0] + [len(level[0]) for level in levels])
+        child_start, child_end = [], []
+        for depth, level in enumerate(levels):
+            if depth + 1 == len(levels):
+                child_start.append(np.zeros(len(level[0]), dtype=np.int64))
+                child_end.append(child_start[-1])
+                continue
+            parents = levels[depth + 1][0] >> np.uint64(2)
+            child_start.append(offsets[depth + 1] +
+                               np.searchsorted(parents, level[0], "left"))
+            child_end.append(offsets[depth + 1] +
+                             np.searchsorted(parents, level[0], "right"))
+        self.child_start = np.concatenate(child_start)
+        self.child_end = np.concatenate(child_end)
+        (_, self.start, self.end, self.mass, self.com, self.center,
+         self.width, self.leaf) = [np.concatenate(column)
+                                   for column in zip(*levels)]
+
+
+class BarnesHut():
+    """Approximate forces with a Barnes-Hut quadtree.
+
+    A tree node is treated as a single body in its center of mass as soon as
+    its width, seen from the body, is smaller than the opening angle
+    ``theta``. This scales with ``N log N`` instead of ``N ** 2``.
+    """
+
+    name = "barneshut"
+
+    def __init__(self, theta=0.5, leaf_size=8, block=4096):
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.block = block
+
+    def __call__(self, positions, masses, out=None, targets=None,
+                 potential=None):
+        tree = QuadTree(positions, masses, self.leaf_size)
+        if targets is None:
+            targets = np.arange(len(masses))
+        if out is None:
+            out = np.empty((len(targets), 2))
+        columns = 2 if potential is None else 3
+        for start in range(0, len(targets), self.block):
+            rows = targets[start:start + self.block]
+            result = self._walk(tree, positions, rows, columns)
+            out[start:start + len(rows)] = result[:, :2]
+            if potential is not None:
+                potential[start:start + len(rows)] = result[:, 2]
+        out *= CONSTANTS.G
+        if potential is not None:
+            potential *= -CONSTANTS.G
+        return out
+
+    def _walk(self, tree, positions, rows, columns=2):
+        """Accelerations (without G) of the bodies rows by a tree walk.
+
+        With three columns, the third is the sum of ``m / r`` that gives the
+        potential.
+        """
+        result = np.zeros((len(rows), columns))
+        pair_row = np.arange(len(rows))
+        pair_node = np.zeros(len(rows), dtype=np.int64)
+        while pair_row.size:
+            target = positions[rows[pair_row]]
+            delta = tree.com[pair_node] - target
+            dist_sq = np.einsum("ij,ij->i", delta, delta)
+            width = tree.width[pair_node]
+            outside = (np.abs(target - tree.center[pair_node]) >
+                       width[:, np.newaxis] / 2).any(axis=1)
+            far = outside & (width ** 2 < self.theta ** 2 * dist_sq)
+            self._accumulate(result, pair_row[far], delta[far], dist_sq[far],
+                             tree.mass[pair_node[far]])
+
+            leaf = ~far & tree.leaf[pair_node]
+            counts = tree.end[pair_node[leaf]] - tree.start[pair_node[leaf]]
+            body_row = np.repeat(pair_row[leaf], counts)
+            bodies = _ranges(tree.start[pair_node[leaf]], counts)
+            other = tree.order[bodies] != rows[body_row]
+            body_row, bodies = body_row[other], bodies[other]
+            delta = tree.positions[bodies] - positions[rows[body_row]]
+            self._accumulate(result, body_row, delta,
+                             np.einsum("ij,ij->i", delta, delta),
+                             tree.masses[bodies])
+
+            inner = ~far & ~tree.leaf[pair_node]
+            nodes = pair_node[inner]
+            counts = tree.child_end[nodes] - tree.child_start[nodes]
+            pair_row = np.repeat(pair_row[inner], counts)
+            pair_node = _ranges(tree.child_start[nodes], counts)
+        return result
+
+    @staticmethod
+    def _accumulate(result, rows, delta, dist_sq, masses):
+        """Add the pull of the masses at delta to the rows of result."""
+        weight = masses * dist_sq ** -1.5
+        for axis in range(2):
+            result[:, axis] += np.bincount(rows, weight * delta[:, axis],
+                                           minlength=len(result))
+        if result.shape[1] > 2:
+            result[:, 2] += np.bincount(rows, masses / np.sqrt(dist_sq),
+                                        minlength=len(result))
+
+
+def _parallel_worker(names, count, worker, workers, go, done):
+    """Loop of a ParallelSum process: sum the forces on its share of targets.
+
+    The main process changes positions, masses and targets and then
+    releases ``go``, this worker writes its rows and then releases ``done``.
+    """
+    # pylint: disable=too-many-arguments
+    blocks = [multiprocessing.shared_memory.SharedMemory(name)
+              for name in names]
+    positions, masses, targets, out, control = ParallelSum.views(blocks,
+                                                                 count)
+    if load_numba() is not None:
+        numba.set_num_threads(1)
+    while True:
+        go.acquire()
+        if not control[0]:
+            break
+        total = control[1]
+        start = total * worker // workers
+        stop = total * (worker + 1) // workers
+        if stop > start:
+            rows = targets[start:stop]
+            if numba is not None:
+                _target_kernel(positions, masses, rows, out[start:stop],
+                               np.empty(0))
+            else:
+                direct_accelerations(positions, masses, out[start:stop],
+                                     rows)
+        done.release()
+    for block in blocks:
+        block.close()
+
+
+_PARALLEL_SUMS = weakref.WeakSet()  # to be closed at exit
+
+
+@atexit.register
+def _close_parallel_sums():
+    """Stop the processes of the ParallelSums still alive."""
+    for backend in list(_PARALLEL_SUMS):
+        backend.close()
+
+
+class ParallelSum():
+    """Exact forces, with the target bodies split across processes.
+
+    Positions, masses and accelerations live in shared memory. For every
+    force evaluation each process is released by its own semaphore and
+    reports back on a shared one. The processes are started on the first
+    use and restarted when the number of bodies changes. They are not
+    forked from this process, whose numba or other threads they could not
+    take along. While waiting, the processes are checked to be alive every
+    ``poll`` seconds. If one died, or could not start, the others are
+    stopped and the forces are summed by PairwiseSum from then on.
+    """
+
+    name = "parallel"
+    start_method = ("forkserver" if "forkserver" in
+                    multiprocessing.get_all_start_methods() else "spawn")
+    poll = 1.0
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.count = None
+        self.blocks = []
+        self.processes = []
+        self.go = []
+        self.done = None
+        self.fallback = None
+        _PARALLEL_SUMS.add(self)
+
+    @staticmethod
+    def views(blocks, count):
+        """Arrays on the shared memory blocks."""
+        return (np.ndarray((count, 2), buffer=blocks[0].buf),
+                np.ndarray(count, buffer=blocks[1].buf),
+                np.ndarray(count, dtype=np.int64, buffer=blocks[2].buf),
+                np.ndarray((count, 2), buffer=blocks[3].buf),
+                np.ndarray(2, dtype=np.int64, buffer=blocks[4].buf))
+
+    def start(self, count):
+        """Create the shared memory and the processes for count bodies."""
+        self.close()
+        self.count = count
+        sizes = (16 * count, 8 * count, 8 * count, 16 * count, 16)
+        self.blocks = [multiprocessing.shared_memory.SharedMemory(
+            create=True, size=max(size, 1)) for size in sizes]
+        (self.positions, self.masses, self.targets, self.out,
+         self.control) = self.views(self.blocks, count)
+        context = multiprocessing.get_context(self.start_method)
+        self.go = [context.Semaphore(0) for _ in range(self.workers)]
+        self.done = context.Semaphore(0)
+        names = [block.name for block in self.blocks]
+        self.processes = [
+            context.Process(
+                target=_parallel_worker, daemon=True,
+                args=(names, count, worker, self.workers, self.go[worker],
+                      self.done))
+            for worker in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+    def collect(self):
+        """Wait for all processes to write their rows.
+
+        Returns False if one of them is no longer alive instead.
+        """
+        for _ in self.processes:
+            while not self.done.acquire(timeout=self.poll):
+                if not all(process.is_alive() for process in self.processes):
+                    return False
+        return True
+
+    def fail(self):
+        """Stop the processes and use PairwiseSum from now on."""
+        codes = [process.exitcode for process in self.processes]
+        self.close()
+        self.fallback = PairwiseSum()
+        warnings.warn("{} processes stopped (exit codes {}), summing the "
+                      "forces in this process from now on".format(
+                          self.name, codes))
+
+    def __call__(self, positions, masses, out=None, targets=None,
+                 potential=None):
+        """Accelerations of the targets, the potential is not filled in."""
+        if self.fallback is None and multiprocessing.current_process().daemon:
+            # e.g. within --ensemble, daemons can't have child processes
+            self.fallback = PairwiseSum()
+        if self.fallback is not None:
+            return self.fallback(positions, masses, out, targets)
+        if self.count != len(masses):
+            self.start(len(masses))
+        if targets is None:
+            targets = np.arange(len(masses))
+        self.positions[:] = positions
+        self.masses[:] = masses
+        self.targets[:len(targets)] = targets
+        self.control[:] = (1, len(targets))
+        for go in self.go:
+            go.release()
+        if not self.collect():
+            self.fail()
+            return self.fallback(positions, masses, out, targets)
+        if out is None:
+            out = np.empty((len(targets), 2))
+        out[:] = self.out[:len(targets)]
+        return out
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop the processes and free the shared memory."""
+        if self.processes:
+            self.control[0] = 0
+            for go in self.go:
+                go.release()
+            for process in self.processes:
+                process.join(self.poll)
+                if process.is_alive():
+                    process.terminate()
+        self.processes = []
+        self.go = []
+        self.done = None
+        self.positions = self.masses = self.targets = None
+        self.out = self.control = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.count = None
+
+
+FORCE_BACKENDS = {
+    DirectSum.name: DirectSum,
+    PairwiseSum.name: PairwiseSum,
+    NumbaSum.name: NumbaSum,
+    ParallelSum.name: ParallelSum,
+    BarnesHut.name: BarnesHut,
+}
+
+
+def make_backend(arguments):
+    """Create the force backend selected on the command line."""
+    if arguments.backend == BarnesHut.name:
+        return BarnesHut(theta=arguments.theta)
+    if arguments.backend == ParallelSum.name:
+        return ParallelSum(workers=arguments.workers)
+    return FORCE_BACKENDS[arguments.backend]()
+
+
+def force_error(backend, positions, masses, samples=1000):
+    """Relative error of a backend's accelerations against the direct sum.
+
+    The error is measured on a random sample of bodies and returned as
+    median and maximum.
+    """
+    count = len(masses)
+    targets = np.random.default_rng(0).choice(
+        count, min(samples, count), replace=False)
+    exact = direct_accelerations(positions, masses, targets=targets)
+    approx = backend(positions, masses, targets=targets)
+    error = (np.linalg.norm(approx - exact, axis=1) /
+             np.linalg.norm(exact, axis=1))
+    return np.median(error), error.max()
+
+
+class Integrator():
+    """Base of the methods to advance the state by one timestep."""
+
+    name = None
+    default_interstep = 1
+    # where a step has a force pass at the positions it ends with: "end"
+    # of the step, "start" of the next one, or None
+    forces_at = None
+
+    def __init__(self, backend=None):
+        self.backend = PairwiseSum() if backend is None else backend
+
+    def accelerations(self, state, positions=None):
+        """Accelerations of all bodies, at their current or given position."""
+        if positions is None:
+            if state.potentials is None:
+                self.backend(state.positions, state.masses,
+                             out=state.accelerations)
+            else:
+                self.backend(state.positions, state.masses,
+                             out=state.accelerations,
+                             potential=state.potentials)
+            state.forces_current = True
+            return state.accelerations
+        return self.backend(positions, state.masses)
+
+    def current_accelerations(self, state):
+        """Accelerations at the current positions, reused if still valid."""
+        if not state.forces_current:
+            self.accelerations(state)
+        return state.accelerations
+
+    def step(self, state, timestep):
+        """Advance the state by timestep seconds."""
+        raise NotImplementedError
+
+    def advance(self, state, timestep):
+        """Step the state and carry its test particles along."""
+        particles = state.particles
+        if particles is not None:
+            particles.start(state, timestep)
+        self.step(state, timestep)
+        if particles is not None:
+            particles.finish(state, timestep)
+
+
+class SemiImplicitEuler(Integrator):
+    """First order: update velocities, then positions with the new ones."""
+
+    name = "euler"
+    default_interstep = 10
+    forces_at = "start"
+
+    def step(self, state, timestep):
+        state.velocities += self.accelerations(state) * timestep
+        state.positions += state.velocities * timestep
+        state.forces_current = False
+
+
+class Leapfrog(Integrator):
+    """Second order symplectic kick-drift-kick (velocity verlet).
+
+    The accelerations at the end of a step are reused at the start of the
+    next one, so this needs one force evaluation per step.
+    """
+
+    name = "leapfrog"
+    default_interstep = 4
+    forces_at = "end"
+
+    def step(self, state, timestep):
+        state.velocities += self.current_accelerations(state) * timestep / 2
+        state.positions += state.velocities * timestep
+        state.velocities += self.accelerations(state) * timestep / 2
+
+
+class Yoshida4(Integrator):
+    """Fourth order symplectic composition of three leapfrog steps."""
+
+    name = "yoshida4"
+    default_interstep = 2
+    _w1 = 1 / (2 - 2 ** (1 / 3))
+    _w0 = -2 ** (1 / 3) * _w1
+    drifts = (_w1 / 2, (_w0 + _w1) / 2, (_w0 + _w1) / 2, _w1 / 2)
+    kicks = (_w1, _w0, _w1)
+
+    def step(self, state, timestep):
+        for drift, kick in zip(self.drifts, self.kicks):
+            state.positions += state.velocities * drift * timestep
+            state.velocities += self.accelerations(state) * kick * timestep
+        state.positions += state.velocities * self.drifts[-1] * timestep
+        state.forces_current = False
+
+
+class NumbaLeapfrog(Leapfrog):
+    """Leapfrog with the whole step compiled by numba.
+
+    Forces are always the exact pairwise ones, the backend is only used
+    for the first evaluation. Falls back to the plain Leapfrog if numba is
+    not installed.
+    """
+
+    name = "numba-leapfrog"
+    default_interstep = 4
+    forces_at = None  # the compiled step leaves no potentials
+
+    def __init__(self, backend=None):
+        super().__init__(backend)
+        load_numba()
+
+    def step(self, state, timestep):
+        if not NumbaSum.available:
+            super().step(state, timestep)
+            return
+        self.current_accelerations(state)
+        _leapfrog_kernel(state.positions, state.velocities, state.masses,
+                         state.accelerations, timestep, 1)
+
+
+class RungeKutta4(Integrator):
+    """Classic explicit fourth order Runge-Kutta."""
+
+    name = "rk4"
+    default_interstep = 2
+    tableau = ((), (1 / 2,), (0, 1 / 2), (0, 0, 1))
+    weights = (1 / 6, 1 / 3, 1 / 3, 1 / 6)
+
+    def stages(self, state, timestep):
+        """Derivatives of positions and velocities at all stages."""
+        d_positions, d_velocities = [], []
+        for row in self.tableau:
+            positions = state.positions + timestep * sum(
+                factor * derivative
+                for factor, derivative in zip(row, d_positions))
+            d_positions.append(state.velocities + timestep * sum(
+                factor * derivative
+                for factor, derivative in zip(row, d_velocities)))
+            d_velocities.append(self.accelerations(state, positions))
+        return d_positions, d_velocities
+
+    @staticmethod
+    def combine(weights, derivatives):
+        """Weighted sum of the stage derivatives."""
+        return sum(weight * derivative
+                   for weight, derivative in zip(weights, derivatives)
+                   if weight)
+
+    def step(self, state, timestep):
+        d_positions, d_velocities = self.stages(state, timestep)
+        state.positions += timestep * self.combine(self.weights, d_positions)
+        state.velocities += timestep * self.combine(self.weights,
+                                                    d_velocities)
+        state.forces_current = False
+
+
+class RungeKuttaFehlberg45(RungeKutta4):
+    """Adaptive Runge-Kutta-Fehlberg 4(5).
+
+    A timestep is split into as many substeps as needed to keep the
+    difference between the fourth and fifth order solution below
+    ``tolerance``, relative to the size of positions and velocities. The
+    last accepted substep size is remembered for the next step. A step
+    fails if the error is not finite or the substeps would have to be
+    shorter than ``min_fraction`` of the timestep.
+    """
+
+    name = "rkf45"
+    default_interstep = 1
+    tableau = ((),
+               (1 / 4,),
+               (3 / 32, 9 / 32),
+               (1932 / 2197, -7200 / 2197, 7296 / 2197),
+               (439 / 216, -8, 3680 / 513, -845 / 4104),
+               (-8 / 27, 2, -3544 / 2565, 1859 / 4104, -11 / 40))
+    weights = (16 / 135, 0, 6656 / 12825, 28561 / 56430, -9 / 50, 2 / 55)
+    weights_low = (25 / 216, 0, 1408 / 2565, 2197 / 4104, -1 / 5, 0)
+    min_fraction = 1e-9
+
+    def __init__(self, backend=None, tolerance=1e-10):
+        super().__init__(backend)
+        self.tolerance = tolerance
+        self.substep = None
+
+    def step(self, state, timestep):
+        remaining = timestep
+        proposed = self.substep or timestep
+        while remaining > timestep * 1e-12:
+            substep = min(proposed, remaining)
+            d_positions, d_velocities = self.stages(state, substep)
+            positions = substep * self.combine(self.weights, d_positions)
+            velocities = substep * self.combine(self.weights, d_velocities)
+            error = max(
+                np.abs(positions - substep * self.combine(
+                    self.weights_low, d_positions)).max() /
+                max(np.abs(state.positions).max(), 1.0),
+                np.abs(velocities - substep * self.combine(
+                    self.weights_low, d_velocities)).max() /
+                max(np.abs(state.velocities).max(), 1.0)) / self.tolerance
+            if not np.isfinite(error):
+                raise FloatingPointError(
+                    "{} error is not finite, are bodies at the same "
+                    "position?".format(self.name))
+            if error <= 1:
+                state.positions += positions
+                state.velocities += velocities
+                remaining -= substep
+                if substep < proposed:
+                    continue  # cut short by the end of the step
+            factor = 0.9 * max(error, 1e-10) ** -0.2
+            proposed = substep * min(max(factor, 0.2), 5.0)
+            if proposed < timestep * self.min_fraction:
+                raise FloatingPointError(
+                    "{} substep fell below {} of the timestep".format(
+                        self.name, self.min_fraction))
+        self.substep = proposed
+        state.forces_current = False
+
+
+class BlockLeapfrog(Integrator):
+    """Leapfrog with individual power of two timesteps per body.
+
+    A body on level ``n`` is kicked every ``timestep / 2 ** n`` seconds, its
+    level follows from ``eta * |a| / |da/dt|``. Only the bodies that are due
+    get their forces evaluated, the others are drifted along and enter the
+    forces with a predicted position. All bodies are synchronized again at
+    the end of each step.
+    """
+
+    name = "block"
+    default_interstep = 1
+
+    def __init__(self, backend=None, eta=0.02, max_level=10):
+        super().__init__(backend)
+        self.eta = eta
+        self.max_level = max_level
+        self.levels = None
+        self.kicks = None
+        self.jerks = None
+        self.evaluations = 0
+
+    def start(self, state, timestep):
+        """Initial accelerations and their time derivative for all bodies."""
+        self.kicks = self.accelerations(state).copy()
+        probe = timestep / (1 << self.max_level)
+        moved = self.accelerations(state, state.positions +
+                                   state.velocities * probe)
+        self.jerks = (moved - self.kicks) / probe
+        self.levels = np.zeros(len(state), dtype=np.int64)
+        self.evaluations += 2 * len(state)
+
+    def wanted_levels(self, bodies, timestep):
+        """Level each of the bodies should be on by the timestep criterion."""
+        wanted = (self.eta * np.linalg.norm(self.kicks[bodies], axis=1) /
+                  np.maximum(np.linalg.norm(self.jerks[bodies], axis=1),
+                             1e-300))
+        with np.errstate(divide="ignore"):
+            levels = np.ceil(np.log2(timestep / wanted))
+        return np.clip(levels, 0, self.max_level).astype(np.int64)
+
+    def relevel(self, bodies, tick, timestep):
+        """Move bodies to their wanted level, if their new step fits tick."""
+        wanted = self.wanted_levels(bodies, timestep)
+        levels = np.maximum(self.levels[bodies], wanted)
+        for _ in range(self.max_level):
+            step = 1 << (self.max_level - levels + 1)
+            coarser = (levels > wanted) & (tick % step == 0)
+            if not coarser.any():
+                break
+            levels[coarser] -= 1
+        self.levels[bodies] = levels
+
+    def predict(self, state, elapsed, steps, tick_length):
+        """Positions of all bodies to second order within their step.
+
+        Bodies that are not due were drifted with the velocity of their
+        first half kick, which misplaces them by ``a * t * (dt - t) / 2``.
+        """
+        elapsed = elapsed * tick_length
+        error = elapsed * (steps * tick_length - elapsed) / 2
+        return state.positions - self.kicks * error[:, None]
+
+    def step(self, state, timestep):
+        if self.levels is None or len(self.levels) != len(state):
+            self.start(state, timestep)
+        ticks = 1 << self.max_level
+        tick_length = timestep / ticks
+        everyone = np.arange(len(state))
+        self.relevel(everyone, 0, timestep)
+        steps = 1 << (self.max_level - self.levels)
+        state.velocities += self.kicks * (steps * tick_length / 2)[:, None]
+        now = 0
+        while now < ticks:
+            following = ((now // steps + 1) * steps).min()
+            state.positions += (state.velocities *
+                                ((following - now) * tick_length))
+            now = following
+            due = np.flatnonzero(now % steps == 0)
+            kicks = self.backend(self.predict(state, now % steps, steps,
+                                              tick_length),
+                                 state.masses, targets=due)
+            self.evaluations += len(due)
+            self.jerks[due] = ((kicks - self.kicks[due]) /
+                               (steps[due] * tick_length)[:, None])
+            self.kicks[due] = kicks
+            state.velocities[due] += kicks * (steps[due] * tick_length /
+                                              2)[:, None]
+            if now < ticks:
+                self.relevel(due, now, timestep)
+                steps = 1 << (self.max_level - self.levels)
+                state.velocities[due] += kicks * (steps[due] * tick_length /
+                                                  2)[:, None]
+        state.forces_current = False
+
+
+INTEGRATORS = {
+    integrator.name: integrator for integrator in (
+        SemiImplicitEuler, Leapfrog, NumbaLeapfrog, Yoshida4, RungeKutta4,
+        RungeKuttaFehlberg45, BlockLeapfrog)
+}
+
+
+def make_integrator(arguments, backend):
+    """Create the integrator selected on the command line."""
+    if arguments.integrator == RungeKuttaFehlberg45.name:
+        return RungeKuttaFehlberg45(backend, tolerance=arguments.tolerance)
+    if arguments.integrator == BlockLeapfrog.name:
+        return BlockLeapfrog(backend, eta=arguments.eta,
+                             max_level=arguments.max_level)
+    return INTEGRATORS[arguments.integrator](backend)
+
+
+# half of the neighbourhood of a cell, as runs of cells along y
+_NEIGHBOURS = ((0, 0, 1), (1, -1, 1))
+
+
+def close_pairs(positions, distance, block=65536):
+    """Pairs of bodies closer than distance, found through a uniform grid.
+
+    The cells of the grid are ``distance`` wide, so close bodies are in
+    the same or neighbouring cells. The bodies are sorted by their cell and
+    look up half of their neighbourhood by binary search, in two runs of
+    consecutive cells. This stays near linear as long as few bodies share
+    a cell. Returns the first and second index (first < second) and the
+    distance of every pair.
+    """
+    cells = np.clip(np.floor(positions / distance), -2 ** 30, 2 ** 30)
+    cells = cells.astype(np.int64)
+    keys = (cells[:, 0] << 32) + cells[:, 1]
+    order = np.argsort(keys, kind="stable")
+    ordered = keys[order]
+    firsts, seconds = [np.empty(0, np.int64)], [np.empty(0, np.int64)]
+    for start in range(0, len(keys), block):
+        rows = order[start:start + block]  # sorted lookups are faster
+        own = ordered[start:start + block]
+        for d_x, low, high in _NEIGHBOURS:
+            starts = np.searchsorted(ordered, own + ((d_x << 32) + low))
+            counts = np.searchsorted(ordered, own + ((d_x << 32) + high),
+                                     "right") - starts
+            first = np.repeat(rows, counts)
+            found = _ranges(starts, counts)
+            second = order[found]
+            if d_x == 0:  # each pair within a cell once, not with itself
+                other = (ordered[found] != np.repeat(own, counts)) | (
+                    first < second)
+                first, second = first[other], second[other]
+            delta = positions[second] - positions[first]
+            dist_sq = np.einsum("ij,ij->i", delta, delta)
+            near = dist_sq < distance ** 2
+            firsts.append(first[near])
+            seconds.append(second[near])
+    first, second = np.concatenate(firsts), np.concatenate(seconds)
+    delta = positions[second] - positions[first]
+    return (np.minimum(first, second), np.maximum(first, second),
+            np.sqrt(np.einsum("ij,ij->i", delta, delta)))
+
+
+class EncounterTracker():
+    """Notice bodies coming close to each other, and colliding.
+
+    The close pairs are found with close_pairs after every update, so this
+    stays near linear in the bodies. An encounter is recorded when a pair
+    comes closer than ``distance``, pairs that start out close (like a
+    planet and its moon) only after they separated once. Pairs closer than
+    ``collision`` collide, by the same rule, with ``merge`` they become one
+    body keeping their mass and momentum. The events are kept in
+    ``events`` and written to a csv sink as they happen, which is continued
+    from ``offset`` when resuming.
+    """
+
+    columns = ["step", "event", "first", "second", "distance", "mass"]
+
+    def __init__(self, state, distance, collision=0, merge=False,
+                 path=None, offset=None):
+        # pylint: disable=too-many-arguments
+        self.distance = distance
+        self.collision = collision
+        self.merge = merge
+        self.sink = None
+        if path is not None:
+            self.sink = CsvSink(path, offset)
+            if offset is None:
+                self.sink.writer.writerow(self.columns)
+        first, second, distances = close_pairs(
+            state.positions, max(distance, collision))
+        self.near = self.pair_keys(state, first, second,
+                                   distances < distance)
+        self.touching = self.pair_keys(state, first, second,
+                                       distances < collision)
+        self.events = []
+
+    @staticmethod
+    def pair_keys(state, first, second, selected):
+        """One number for each of the selected pairs, to compare them."""
+        return first[selected] * len(state) + second[selected]
+
+    def update(self, state, step):
+        """Record the pairs that came close since the last update.
+
+        Returns the new index of every old body if some merged, else None.
+        """
+        first, second, distances = close_pairs(
+            state.positions, max(self.distance, self.collision))
+        near = distances < self.distance
+        keys = self.pair_keys(state, first, second, near)
+        for index in np.flatnonzero(near)[~np.isin(keys, self.near)]:
+            self.record(state, step, "encounter", first[index],
+                        second[index], distances[index])
+        self.near = keys
+        touching = distances < self.collision
+        keys = self.pair_keys(state, first, second, touching)
+        new = np.flatnonzero(touching)[~np.isin(keys, self.touching)]
+        self.touching = keys
+        if self.merge and len(new):
+            return self.join(state, step, first[new], second[new],
+                             distances[new])
+        for index in new:
+            self.record(state, step, "collision", first[index],
+                        second[index], distances[index])
+        return None
+
+    def join(self, state, step, first, second, distances):
+        """Merge colliding pairs, closest first, into the heavier body.
+
+        Chains of collisions end up in one body. The merged body is at the
+        center of mass and moves with the total momentum.
+        """
+        # pylint: disable=too-many-arguments
+        into = np.arange(len(state))
+        for pair in np.argsort(distances):
+            survivor, absorbed = first[pair], second[pair]
+            while into[survivor] != survivor:
+                survivor = into[survivor]
+            while into[absorbed] != absorbed:
+                absorbed = into[absorbed]
+            if survivor == absorbed:
+                continue
+            if state.masses[absorbed] > state.masses[survivor]:
+                survivor, absorbed = absorbed, survivor
+            masses = state.masses[[survivor, absorbed], np.newaxis]
+            total = masses.sum()
+            for array in (state.positions, state.velocities):
+                array[survivor] = (masses * array[[survivor, absorbed]]).sum(
+                    axis=0) / total
+            state.masses[survivor] = total
+            into[absorbed] = survivor
+            self.record(state, step, "collision", survivor, absorbed,
+                        distances[pair], total)
+        remap = state.remove(np.flatnonzero(into != np.arange(len(into))))
+        self.near = self.remap_keys(state, remap, self.near)
+        self.touching = self.remap_keys(state, remap, self.touching)
+        return remap
+
+    @staticmethod
+    def remap_keys(state, remap, keys):
+        """Keys of the pairs after a merge, without the removed bodies."""
+        pairs = remap[np.stack([keys // len(remap), keys % len(remap)],
+                               axis=-1)]
+        kept = (pairs >= 0).all(axis=1)
+        return pairs[kept, 0] * len(state) + pairs[kept, 1]
+
+    def record(self, state, step, event, first, second, distance,
+               mass=None):
+        """Keep an event and write it to the sink."""
+        # pylint: disable=too-many-arguments
+        names = [state.bodies[first].name, state.bodies[second].name]
+        self.events.append({"step": step, "event": event, "bodies": names,
+                            "distance": float(distance)})
+        if mass is not None:
+            self.events[-1]["mass"] = float(mass)
+        if self.sink is not None:
+            self.sink.writer.writerow(
+                [step, event, *names, distance, "" if mass is None else mass])
+            self.sink.file.flush()
+
+    def tell(self):
+        """Size of the output, to continue there later, None without one."""
+        return None if self.sink is None else self.sink.file.tell()
+
+    def close(self):
+        """Close the sink."""
+        if self.sink is not None:
+            self.sink.close()
+
+
+class ConservationError(RuntimeError):
+    """A conserved quantity drifted further than allowed."""
+
+
+class Diagnostics():
+    """Energy, momentum and angular momentum, measured every few steps.
+
+    The potential energy is taken from a force pass at the positions after
+    a due step, where the integrator has one (``forces_at``): the state is
+    asked for potentials just before, so the backend gets ``1 / r`` from
+    the distances it calculates anyway. With ``"end"`` that is the last
+    pass of the due step, with ``"start"`` the first one of the step after,
+    and the diagnostics are only completed then. Other integrators, and
+    backends that do not fill in the potential, cost an extra pass over
+    all pairs every ``every`` steps instead. The drift relative to the
+    ``reference`` values at the start is written to a csv sink and checked
+    against ``max_drift``. Quantities that start out as 0 drift relative
+    to the sum of their magnitudes over the bodies. A resumed run passes
+    the reference of the checkpoint and the ``offset`` to continue the sink
+    from.
+    """
+
+    columns = ["step", "energy", "momentum_x", "momentum_y",
+               "angular_momentum", "energy_drift", "momentum_drift",
+               "angular_momentum_drift"]
+
+    def __init__(self, state, every, path=None, max_drift=None,
+                 action="warn", first_step=0, reference=None, offset=None,
+                 forces_at=None):
+        # pylint: disable=too-many-arguments
+        self.every = every
+        self.forces_at = forces_at
+        self.max_drift = max_drift
+        self.action = action
+        self.sink = None
+        if path is not None:
+            self.sink = CsvSink(path, offset)
+            if offset is None:
+                self.sink.writer.writerow(self.columns)
+        self.reference = (self.measure(state, state.potential_energy())
+                          if reference is None else np.asarray(reference))
+        self.reused = self.sweeps = 0
+        self.warned = False
+        self.pending = None  # step and copy of the state to complete
+        if forces_at == "end" and self.due(first_step):
+            self.request(state)
+        elif forces_at == "start" and first_step and self.due(first_step - 1):
+            self.defer(state, first_step - 1)
+
+    def due(self, step):
+        """Whether the diagnostics are taken after this step."""
+        return (step + 1) % self.every == 0
+
+    @staticmethod
+    def request(state):
+        """Have the next force pass fill in the potentials."""
+        state.potentials = np.full(len(state), np.nan)
+
+    def defer(self, state, step):
+        """Keep the state after step to complete once the next step filled
+        in the potentials at its positions."""
+        self.pending = step, SystemState(state.masses, state.positions,
+                                         state.velocities)
+        self.request(state)
+
+    def potential_energy(self, state, potentials):
+        """Potential energy from the potentials of a force pass at the
+        positions of state if they were all filled in, else from a sweep."""
+        if (potentials is not None and len(potentials) == len(state) and
+                not np.isnan(potentials).any()):
+            self.reused += 1
+            return 0.5 * np.dot(state.masses, potentials)
+        self.sweeps += 1
+        return state.potential_energy()
+
+    def complete(self, potentials):
+        """Take the diagnostics of the deferred state."""
+        (step, pending), self.pending = self.pending, None
+        self.check(step, self.measure(
+            pending, self.potential_energy(pending, potentials)))
+
+    @staticmethod
+    def measure(state, potential_energy):
+        """Energy, momentum and angular momentum of the state.
+
+        Followed by the sums of the magnitudes of the momenta, angular
+        momenta and energies of the bodies, to scale drifts with.
+        """
+        momenta = state.velocities * state.masses[:, np.newaxis]
+        kinetic = state.kinetic_energy()
+        angular = (state.positions[:, 0] * momenta[:, 1] -
+                   state.positions[:, 1] * momenta[:, 0])
+        return np.array([
+            kinetic + potential_energy,
+            *momenta.sum(axis=0),
+            angular.sum(),
+            np.linalg.norm(momenta, axis=1).sum(),
+            np.abs(angular).sum(),
+            kinetic - potential_energy])
+
+    @staticmethod
+    def relative(change, *scales):
+        """Size of change relative to the first scale that is not 0."""
+        scale = next((scale for scale in scales if scale), 1.0)
+        return abs(change) / scale
+
+    def update(self, state, step):
+        """Take the diagnostics after a due step, prepare the next one."""
+        potentials = state.potentials
+        state.potentials = None
+        if self.pending is not None:
+            self.complete(potentials)
+        if self.due(step):
+            if self.forces_at == "start":
+                self.defer(state, step)
+            else:
+                self.check(step, self.measure(state, self.potential_energy(
+                    state, potentials if state.forces_current else None)))
+        if self.forces_at == "end" and self.due(step + 1):
+            self.request(state)
+
+    def check(self, step, values):
+        """Write the values with their drift and compare it to the limit."""
+        reference = self.reference
+        drift = (self.relative(values[0] - reference[0], abs(reference[0]),
+                               reference[6], values[6]),
+                 self.relative(math.hypot(*(values[1:3] - reference[1:3])),
+                               reference[4], values[4]),
+                 self.relative(values[3] - reference[3], abs(reference[3]),
+                               reference[5], values[5]))
+        if self.sink is not None:
+            self.sink.write(np.array([[step, *values[:4], *drift]]))
+        if self.max_drift is None or max(drift) <= self.max_drift:
+            return
+        message = ("conservation drift {:.2e} after step {} is more than "
+                   "{:.2e}".format(max(drift), step, self.max_drift))
+        if self.action == "abort":
+            raise ConservationError(message)
+        if not self.warned:
+            warnings.warn(message + ", further ones are only in the output")
+            self.warned = True
+
+    def tell(self):
+        """Size of the output, to continue there later, None without one."""
+        return None if self.sink is None else self.sink.file.tell()
+
+    def close(self):
+        """Complete deferred diagnostics and close the sink."""
+        try:
+            if self.pending is not None:
+                self.complete(None)
+        finally:
+            if self.sink is not None:
+                self.sink.close()
+
+
+def open_output(path, offset=None, binary=False):
+    """Open an output file, or continue it at offset when resuming."""
+    if offset is None:
+        return open(path, "wb" if binary else "w")
+    with open(path, "r+b") as output:
+        output.truncate(offset)
+    return open(path, "ab" if binary else "a")
+
+
+class CsvSink():
+    """Write trajectory rows as csv: step, then x and y of every body."""
+
+    def __init__(self, path, offset=None):
+        self.file = open_output(path, offset)
+        self.writer = csv.writer(self.file, lineterminator="\n")
+
+    def write(self, rows):
+        """Append rows and push them to disk."""
+        self.writer.writerows([int(row[0]), *row[1:]]
+                              for row in rows.tolist())
+        self.file.flush()
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+class NpySink():
+    """Write trajectory rows as a sequence of .npy arrays in one file.
+
+    Every chunk is a complete array, read them back with read_npy_chunks.
+    """
+
+    def __init__(self, path, offset=None):
+        self.file = open_output(path, offset, binary=True)
+
+    def write(self, rows):
+        """Append rows as one array and push it to disk."""
+        np.save(self.file, rows)
+        self.file.flush()
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+class TrajSink():
+    """Write frames in the fixed record binary trajectory format.
+
+    The file starts with ``Trajectory.magic``, the length of a json header
+    and the header itself, padded to a multiple of 8 bytes. Then follow the
+    frames, each holding x, y, vx and vy of every body as float64.
+    """
+
+    def __init__(self, path, header, offset=None):
+        self.file = open_output(path, offset, binary=True)
+        if offset is not None:
+            return
+        encoded = json.dumps(header).encode()
+        encoded += b" " * (-(len(Trajectory.magic) + 4 + len(encoded)) % 8)
+        self.file.write(Trajectory.magic)
+        self.file.write(struct.pack("<I", len(encoded)))
+        self.file.write(encoded)
+
+    def write(self, rows):
+        """Append frames and push them to disk."""
+        self.file.write(rows.astype("<f8", copy=False).tobytes())
+        self.file.flush()
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+SINKS = {"csv": CsvSink, "npy": NpySink, "traj": TrajSink}
+
+
+def read_npy_chunks(path):
+    """Load all chunks written by a NpySink as one array."""
+    chunks = []
+    with open(path, "rb") as npy_file:
+        while npy_file.peek(1):
+            chunks.append(np.load(npy_file))
+    return np.concatenate(chunks)
+
+
+class TrajectoryWriter():
+    """Log positions of some bodies, flushed to a sink in bounded chunks.
+
+    Only every ``every``-th step is logged, and at most ``chunk_size`` rows
+    are held in memory before they are written out. Bodies that were
+    removed by merging are logged as NaN.
+    """
+
+    def __init__(self, sink, indices, every=1, chunk_size=4096):
+        self.sink = sink
+        self.indices = np.asarray(indices)
+        self.gone = np.zeros(len(self.indices), dtype=bool)
+        self.every = every
+        self.rows = np.empty((chunk_size, 1 + 2 * len(self.indices)))
+        self.filled = 0
+
+    def remap(self, remap):
+        """Follow the logged bodies to their new index after a merge."""
+        self.indices = remap[self.indices]
+        self.gone |= self.indices < 0
+
+    def picked(self, array):
+        """Rows of the logged bodies in array, NaN for removed ones."""
+        rows = array[self.indices]
+        rows[self.gone] = np.nan
+        return rows
+
+    def record(self, step, state):
+        """Log the state at step, if it is one to be logged."""
+        if step % self.every:
+            return
+        row = self.rows[self.filled]
+        row[0] = step
+        row[1:] = self.picked(state.positions).ravel()
+        self.filled += 1
+        if self.filled == len(self.rows):
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered rows to the sink."""
+        if self.filled:
+            self.sink.write(self.rows[:self.filled])
+            self.filled = 0
+
+    def tell(self):
+        """Flush and get the size of the output, to continue there later."""
+        self.flush()
+        return self.sink.file.tell()
+
+    def close(self):
+        """Flush the remaining rows and close the sink."""
+        self.flush()
+        self.sink.close()
+
+
+class FrameWriter(TrajectoryWriter):
+    """Log positions and velocities of bodies as frames of a TrajSink."""
+
+    def __init__(self, sink, indices, every=1, chunk_size=4096):
+        super().__init__(sink, indices, every, chunk_size)
+        self.rows = np.empty((chunk_size, len(self.indices), 4))
+
+    def record(self, step, state):
+        if step % self.every:
+            return
+        frame = self.rows[self.filled]
+        frame[:, :2] = self.picked(state.positions)
+        frame[:, 2:] = self.picked(state.velocities)
+        self.filled += 1
+        if self.filled == len(self.rows):
+            self.flush()
+
+
+class Trajectory():
+    """A binary trajectory file, memory mapped for reading.
+
+    ``frames`` is an array of shape (frames, bodies, 4) holding x, y, vx and
+    vy, that is only read from disk where it is accessed.
+    """
+
+    magic = b"SOLTRAJ1"
+
+    def __init__(self, path):
+        with open(path, "rb") as traj_file:
+            if traj_file.read(len(self.magic)) != self.magic:
+                raise ValueError("{} is no trajectory file".format(path))
+            length, = struct.unpack("<I", traj_file.read(4))
+            self.header = json.loads(traj_file.read(length))
+        offset = len(self.magic) + 4 + length
+        shape = (len(self.header["names"]), 4)
+        count = (os.path.getsize(path) - offset) // (8 * shape[0] * 4)
+        if count:
+            self.frames = np.memmap(path, dtype="<f8", mode="r",
+                                    offset=offset, shape=(count, *shape))
+        else:
+            self.frames = np.empty((0, *shape))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @staticmethod
+    def create_header(state, indices, timestep, every, start_step=0,
+                      interstep=1):
+        """Describe the logged bodies and timing for a new file."""
+        return {
+            **state.describe(indices),
+            "masses": state.masses[indices].tolist(),
+            "timestep": timestep,
+            "every": every,
+            "start_step": start_step,
+            "interstep": interstep,
+        }
+
+    def step_of(self, frame):
+        """Number of steps (sub-iterations) simulated in a frame.
+
+        A step is logged after it was taken, so frame 0 of a run starting at
+        step 0 already holds the state after one step.
+        """
+        return self.header["start_step"] + frame * self.header["every"] + 1
+
+    def frame_at(self, step):
+        """Index of the last frame logged at or before step."""
+        frame = (step - 1 - self.header["start_step"]) // self.header["every"]
+        return min(max(frame, 0), len(self) - 1)
+
+    def time_of(self, frame):
+        """Simulated seconds at which a frame was logged."""
+        return self.step_of(frame) * self.header["timestep"]
+
+    def state(self):
+        """SystemState of the bodies described by the header, at their
+        first position, without an object per body."""
+        first = self.frames[0] if len(self) else np.zeros((len(
+            self.header["names"]), 4))
+        return SystemState.from_arrays(
+            self.header["masses"], first[:, :2], first[:, 2:],
+            self.header["names"], self.header["colors"],
+            self.header.get("sizes", [Celestial.size] * len(first)))
+
+
+class Ephemeris():
+    """Positions and velocities of recorded bodies at any time of a run.
+
+    Reads a binary trajectory (``--format traj``). Between two logged
+    frames every coordinate follows the cubic Hermite polynomial through
+    the positions and velocities at both frames. The polynomials of a body
+    are fitted for ``segment`` frames at a time, when first needed, and the
+    last ``cache`` of these segments are kept. Neither the frames nor all
+    segments have to fit in memory. Times are seconds since step 0.
+    """
+
+    def __init__(self, path, segment=256, cache=256):
+        self.trajectory = Trajectory(path)
+        if len(self.trajectory) < 2:
+            raise ValueError("{} needs at least two frames".format(path))
+        self.names = self.trajectory.header["names"]
+        self.segment = segment
+        self.start = self.trajectory.time_of(0)
+        self.end = self.trajectory.time_of(len(self.trajectory) - 1)
+        self.interval = self.trajectory.time_of(1) - self.start
+        self.coefficients = functools.lru_cache(cache)(self.fit)
+
+    def index_of(self, body):
+        """Index of a body given by name or index."""
+        return self.names.index(body) if isinstance(body, str) else body
+
+    def fit(self, body, segment):
+        """Hermite coefficients of one segment of frames of a body.
+
+        Shape (intervals, 4, 2), for the powers 0 to 3 of the fraction of
+        the interval that passed.
+        """
+        first = segment * self.segment
+        frames = np.array(self.trajectory.frames[
+            first:first + self.segment + 1, body])
+        start, end = frames[:-1], frames[1:]
+        slope_start = start[:, 2:] * self.interval
+        slope_end = end[:, 2:] * self.interval
+        change = end[:, :2] - start[:, :2]
+        return np.stack([start[:, :2], slope_start,
+                         3 * change - 2 * slope_start - slope_end,
+                         slope_start + slope_end - 2 * change], axis=1)
+
+    def state(self, body, times):
+        """Positions and velocities of a body at the given times."""
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        if times.min() < self.start or times.max() > self.end:
+            raise ValueError("times have to be within {} and {}".format(
+                self.start, self.end))
+        body = self.index_of(body)
+        elapsed = (times - self.start) / self.interval
+        intervals = np.minimum(elapsed.astype(np.int64),
+                               len(self.trajectory) - 2)
+        fractions = (elapsed - intervals)[:, np.newaxis]
+        segments = intervals // self.segment
+        coefficients = np.empty((len(times), 4, 2))
+        for segment in np.unique(segments):
+            queries = segments == segment
+            coefficients[queries] = self.coefficients(body, int(segment))[
+                intervals[queries] - segment * self.segment]
+        positions = coefficients[:, 0] + fractions * (
+            coefficients[:, 1] + fractions * (
+                coefficients[:, 2] + fractions * coefficients[:, 3]))
+        velocities = (coefficients[:, 1] + fractions * (
+            2 * coefficients[:, 2] + fractions * 3 * coefficients[:, 3])
+                      ) / self.interval
+        return positions, velocities
+
+    def position(self, body, times):
+        """Positions of a body at the given times."""
+        return self.state(body, times)[0]
+
+    def velocity(self, body, times):
+        """Velocities of a body at the given times."""
+        return self.state(body, times)[1]
+
+
+def create_trajectory_writer(arguments, state, offset=None):
+    """Create the writer for the planets selected on the command line.
+
+    With an offset, the output of a resumed run is continued from there.
+    """
+    if not arguments.logplanet:
+        return None
+    if arguments.logplanet == ["all"]:
+        indices = range(len(state))
+    else:
+        indices = [state.index_of(name) for name in arguments.logplanet]
+    output_format = arguments.format or os.path.splitext(
+        arguments.output)[1].lstrip(".")
+    if output_format == "traj":
+        header = Trajectory.create_header(
+            state, indices, arguments.timestep, arguments.log_every,
+            interstep=arguments.interstep)
+        return FrameWriter(TrajSink(arguments.output, header, offset),
+                           indices, arguments.log_every, arguments.chunk_size)
+    return TrajectoryWriter(SINKS[output_format](arguments.output, offset),
+                            indices, arguments.log_every, arguments.chunk_size)
+
+
+def create_simulation(arguments, state=None):
+    """Set up the bodies, force backend and integrator of a run."""
+    if state is None:
+        state = load_scenario(arguments.scenario)
+        if arguments.asteroids:
+            inner, outer = arguments.belt
+            asteroid_belt(state, arguments.asteroids, inner, outer,
+                          mass=arguments.asteroid_mass)
+        state = state.build()
+    backend = make_backend(arguments)
+    integrator = make_integrator(arguments, backend)
+    if state.particles is not None and (
+            isinstance(backend, NumbaSum) or
+            isinstance(integrator, NumbaLeapfrog)):
+        state.particles.compile()
+    return state, backend, integrator
+
+
+class Checkpointer():
+    """Periodically save everything needed to resume a simulation.
+
+    The state is copied within the simulation loop, pickling and writing
+    happens in a background thread. The checkpoint is written to a
+    temporary file first and then renamed, so there always is a complete
+    one on disk.
+    """
+
+    def __init__(self, path, every):
+        self.path = path
+        self.every = every
+        self.thread = None
+
+    def update(self, step, state, integrator, trajectory=None,
+               encounters=None, diagnostics=None):
+        """Save a checkpoint if step is one of the steps to save at."""
+        # pylint: disable=too-many-arguments
+        if self.every and step % self.every == 0:
+            self.save(step, state, integrator, trajectory, encounters,
+                      diagnostics)
+
+    def save(self, step, state, integrator, trajectory=None,
+             encounters=None, diagnostics=None):
+        """Start writing a checkpoint of the state after step."""
+        # pylint: disable=too-many-arguments
+        data = {
+            "step": step,
+            **state.describe(),
+            "masses": state.masses.copy(),
+            "positions": state.positions.copy(),
+            "velocities": state.velocities.copy(),
+            "particles": None if state.particles is None else {
+                **state.particles.describe(),
+                "positions": state.particles.positions.copy(),
+                "velocities": state.particles.velocities.copy()},
+            "random": random.getstate(),
+            "integrator": copy.deepcopy({
+                key: value for key, value in vars(integrator).items()
+                if key != "backend"}),
+            "output_offset": (None if trajectory is None
+                              else trajectory.tell()),
+            "events_offset": (None if encounters is None
+                              else encounters.tell()),
+            "diagnostics_reference": (None if diagnostics is None
+                                      else diagnostics.reference.copy()),
+            "diagnostics_offset": (None if diagnostics is None
+                                   else diagnostics.tell()),
+        }
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(data,))
+        self.thread.start()
+
+    def write(self, data):
+        """Write and atomically rename a checkpoint."""
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as checkpoint_file:
+            pickle.dump(data, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary, self.path)
+
+    def wait(self):
+        """Wait for the checkpoint that is being written."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @staticmethod
+    def load(path):
+        """Read a checkpoint."""
+        with open(path, "rb") as checkpoint_file:
+            return pickle.load(checkpoint_file)
+
+
+def resume_simulation(arguments):
+    """Set up a run from the checkpoint given by --resume."""
+    data = Checkpointer.load(arguments.resume)
+    state = SystemState.from_arrays(
+        data["masses"], data["positions"], data["velocities"],
+        data["names"], data["colors"], data["sizes"])
+    if data.get("particles") is not None:
+        state.particles = TestParticles(**data["particles"])
+    state, backend, integrator = create_simulation(arguments, state)
+    vars(integrator).update(data["integrator"])
+    random.setstate(data["random"])
+    return state, backend, integrator, data
+
+
+def run_seed(arguments, seed):
+    """Run one headless simulation and summarize how it ended."""
+    random.seed(seed)
+    state, backend, integrator = create_simulation(arguments)
+    energy = state.total_energy()
+    encounters = EncounterTracker(
+        state, arguments.encounter_distance * CONSTANTS.AU,
+        arguments.collision_distance * CONSTANTS.AU, arguments.merge)
+    try:
+        for step in range(arguments.duration * arguments.interstep):
+            integrator.advance(state, arguments.timestep)
+            encounters.update(state, step)
+    finally:
+        if isinstance(backend, ParallelSum):
+            backend.close()  # pool processes skip atexit
+    return {
+        "seed": seed,
+        "energy_drift": (state.total_energy() - energy) / abs(energy),
+        "bodies": {
+            body.name: [*state.positions[index], *state.velocities[index]]
+            for index, body in enumerate(state.bodies)},
+        "encounters": encounters.events,
+    }
+
+
+def run_ensemble(arguments):
+    """Run a simulation for every seed across a pool of processes."""
+    summaries = []
+    with concurrent.futures.ProcessPoolExecutor(arguments.workers) as pool:
+        futures = [pool.submit(run_seed, arguments, seed)
+                   for seed in arguments.ensemble]
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures),
+                                total=len(futures), ascii=True, ncols=80):
+            summaries.append(future.result())
+    summaries.sort(key=lambda summary: summary["seed"])
+    with open("ensemble_out.json", "w") as json_file:
+        json.dump(summaries, json_file, indent=1)
+
+
+def seed_range(text):
+    """Parse ``START:STOP`` or ``COUNT`` into a range of seeds."""
+    start, _, stop = text.rpartition(":")
+    return range(int(start or 0), int(stop))
+
+
 def pygameinit():
     """nix"""
     pygame.init()
@@ -384,7 +2924,7 @@ def append_planets(celestials):
         position=data[0], velocity=data[1]))
     data = get_starting_info(3.84400e+8, 1e+3, celestials[-1])
     celestials.append(Planet(
-        "luna", mass=7.34767309e+22, color=col("white"),
+        "luna", mass=7.34767309e+22, color=col("white"), size=5,
         position=data[0], velocity=data[1]))
     data = get_starting_info(distance=2.279e+11, speed=2.41e+4)
     celestials.append(Planet(
@@ -446,6 +2986,215 @@ def append_planets_old(celestials):
         velocity=(0, 5.515e+3), color=col("grey")))
 
 
+class Scenario():
+    """Initial conditions collected as arrays, to build a SystemState from.
+
+    Bodies are added one by one from scenario files, or as whole arrays by
+    bulk files and generators, without creating an object per body.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.names = []
+        self.colors = []
+        self.sizes = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, masses, positions, velocities, names, color="grey",
+            size=1):
+        """Add bodies, color and size are per body or shared by all."""
+        # pylint: disable=too-many-arguments
+        count = len(names)
+        self.parts.append((
+            np.broadcast_to(np.asarray(masses, dtype=float), (count,)),
+            np.asarray(positions, dtype=float).reshape(count, 2),
+            np.asarray(velocities, dtype=float).reshape(count, 2)))
+        self.names.extend(names)
+        self.colors.extend([color] * count if isinstance(color, str)
+                           else color)
+        self.sizes.extend([size] * count if np.isscalar(size) else size)
+
+    def add_celestials(self, celestials):
+        """Add bodies built as Planet objects."""
+        self.add([body.mass for body in celestials],
+                 [body.position.x_y for body in celestials],
+                 [body.velocity.x_y for body in celestials],
+                 [body.name for body in celestials],
+                 [MyColor(body.color).text for body in celestials],
+                 [body.size for body in celestials])
+
+    def arrays(self):
+        """Masses, positions and velocities of all bodies added so far."""
+        if not self.parts:
+            return np.empty(0), np.empty((0, 2)), np.empty((0, 2))
+        return tuple(np.concatenate(arrays) for arrays in zip(*self.parts))
+
+    def orbits(self, radii, angles, around=None, speeds=None):
+        """Positions and velocities on orbits around a body.
+
+        Without speeds, the orbits are circular. Like get_starting_info, an
+        angle of 0 is straight above the primary, moving to the left.
+        """
+        masses, positions, velocities = self.arrays()
+        if around is None:
+            primary = (0.0, np.zeros(2), np.zeros(2))
+        else:
+            index = self.names.index(around)
+            primary = masses[index], positions[index], velocities[index]
+        radii, angles = np.asarray(radii), np.asarray(angles)
+        if speeds is None:
+            if not primary[0]:
+                raise ValueError("circular orbits need a body to go around")
+            speeds = np.sqrt(CONSTANTS.G * primary[0] / radii)
+        sin, cos = np.sin(angles), np.cos(angles)
+        return (primary[1] + np.stack([sin, cos], axis=-1) * radii[..., None],
+                primary[2] + np.stack([-cos, sin], axis=-1) *
+                np.asarray(speeds)[..., None])
+
+    def heaviest(self):
+        """Name of the most massive body."""
+        return self.names[int(np.argmax(self.arrays()[0]))]
+
+    def build(self):
+        """The SystemState of all bodies, those without mass become its
+        test particles."""
+        masses, positions, velocities = self.arrays()
+        massless = masses == 0
+        if not massless.any():
+            return SystemState.from_arrays(masses, positions, velocities,
+                                           self.names, self.colors,
+                                           self.sizes)
+
+        def described(indices):
+            return {"names": [self.names[index] for index in indices],
+                    "colors": [self.colors[index] for index in indices],
+                    "sizes": [self.sizes[index] for index in indices]}
+
+        heavy, light = np.flatnonzero(~massless), np.flatnonzero(massless)
+        state = SystemState.from_arrays(masses[heavy], positions[heavy],
+                                        velocities[heavy], **described(heavy))
+        state.particles = TestParticles(positions[light], velocities[light],
+                                        **described(light))
+        return state
+
+
+def add_body(scenario, entry):
+    """Add a body described by a scenario file entry.
+
+    Either ``position`` and ``velocity`` are given (in m and m/s), or an
+    ``orbit`` with the ``distance``, the body to go ``around`` (the
+    heaviest one so far if left out), the ``speed`` (circular if left out)
+    and the ``angle`` (in degrees, random if left out).
+    """
+    position, velocity = entry.get("position", (0, 0)), entry.get(
+        "velocity", (0, 0))
+    if "orbit" in entry:
+        orbit = entry["orbit"]
+        angle = (math.radians(orbit["angle"]) if "angle" in orbit
+                 else random.random() * math.pi * 2)
+        around = orbit.get("around")
+        if around is None and scenario.names:
+            around = scenario.heaviest()
+        position, velocity = scenario.orbits(
+            [orbit["distance"]], [angle], around,
+            None if "speed" not in orbit else [orbit["speed"]])
+    scenario.add([entry["mass"]], position, velocity, [entry["name"]],
+                 entry.get("color", "black"), entry.get("size", 20))
+
+
+def read_bulk(scenario, entry, directory=""):
+    """Add the bodies of a csv or npy file, as given by a scenario entry.
+
+    The file has the columns mass, x, y, vx and vy in SI units: a csv file
+    with a header line, an npy file as structured array with these fields
+    or as plain array with the columns in this order. The bodies are named
+    after the file and share ``color`` and ``size`` of the entry.
+    """
+    columns = ["mass", "x", "y", "vx", "vy"]
+    path = os.path.join(directory, entry["path"])
+    if path.endswith(".npy"):
+        data = np.load(path)
+        if data.dtype.names:
+            data = np.stack([data[column] for column in columns], axis=-1)
+    else:
+        with open(path) as csv_file:
+            header = [name.strip() for name in csv_file.readline().split(",")]
+            data = np.loadtxt(csv_file, delimiter=",", ndmin=2)
+        if not set(columns) <= set(header):
+            raise ValueError("{} needs the columns {}".format(
+                path, ", ".join(columns)))
+        data = data[:, [header.index(column) for column in columns]]
+    name = entry.get("name", os.path.splitext(os.path.basename(path))[0])
+    scenario.add(data[:, 0], data[:, 1:3], data[:, 3:5],
+                 ["{} {}".format(name, index) for index in range(len(data))],
+                 entry.get("color", "grey"), entry.get("size", 1))
+
+
+def asteroid_belt(scenario, count, inner=2.1, outer=3.3, around=None,
+                  mass=1e15, color="grey", size=1, seed=None,
+                  name="asteroid"):
+    """Add count bodies on circular orbits between inner and outer AU.
+
+    They are spread evenly over the area of the ring, around the most
+    massive body unless given.
+    """
+    # pylint: disable=too-many-arguments
+    rng = np.random.default_rng(random.getrandbits(32) if seed is None
+                                else seed)
+    radii = np.sqrt(rng.uniform(inner ** 2, outer ** 2, count)) * CONSTANTS.AU
+    angles = rng.uniform(0, 2 * math.pi, count)
+    positions, velocities = scenario.orbits(
+        radii, angles, scenario.heaviest() if around is None else around)
+    scenario.add(mass, positions, velocities,
+                 ["{} {}".format(name, index) for index in range(count)],
+                 color, size)
+
+
+GENERATORS = {
+    "belt": asteroid_belt,
+}
+
+
+def load_scenario(path=None):
+    """Read the initial conditions of a scenario file.
+
+    Without a path (or with "solar") this is the solar system of
+    append_planets. Json and toml files list single ``bodies``, bulk
+    ``files`` (see read_bulk) and ``generators`` (with their ``type`` from
+    GENERATORS and its arguments), which are added in this order. A csv or
+    npy file alone is read as bulk file. Bodies with a mass of 0 become
+    test particles.
+    """
+    scenario = Scenario()
+    if path is None or path == "solar":
+        celestials = []
+        append_planets(celestials)
+        scenario.add_celestials(celestials)
+        return scenario
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".csv", ".npy"):
+        read_bulk(scenario, {"path": path})
+        return scenario
+    if extension == ".toml":
+        if tomllib is None:
+            raise ImportError("toml scenarios need python 3.11 or later")
+        with open(path, "rb") as toml_file:
+            data = tomllib.load(toml_file)
+    else:
+        with open(path) as json_file:
+            data = json.load(json_file)
+    for entry in data.get("bodies", []):
+        add_body(scenario, entry)
+    for entry in data.get("files", []):
+        read_bulk(scenario, entry, os.path.dirname(path))
+    for entry in data.get("generators", []):
+        options = dict(entry)
+        GENERATORS[options.pop("type")](scenario, **options)
+    return scenario
+
+
 class EventHandler():
     """Event Handler"""
 
@@ -455,6 +3204,8 @@ class EventHandler():
         self.held_delay = {}
         self.followmode = False
         self.follownum = 0
+        self.seek = 0
+        self.paused = False
 
     def check_events(self):
         """Check for events."""
@@ -481,6 +3232,12 @@ class EventHandler():
             self.follownum += 1
         elif self.followmode and key in (pygame.K_s, pygame.K_DOWN):
             self.follownum -= 1
+        elif key == pygame.K_PAGEUP:
+            self.seek += 1
+        elif key == pygame.K_PAGEDOWN:
+            self.seek -= 1
+        elif key == pygame.K_SPACE:
+            self.paused = not self.paused
         elif key == pygame.K_ESCAPE:
             exit()
 
@@ -512,6 +3269,342 @@ class EventHandler():
             self.held_delay[key] = (self.held_delay[key] + 1) % 5
 
 
+def draw_step(canvas, state, eventhandler):
+    """Draw the current stakte to the pygame convas"""
+    if eventhandler.followmode:
+        canvas.follow(state.bodies[eventhandler.follownum
+                                   % len(state)].position)
+    canvas.draw(state)
+
+
+class TimedBackend():
+    """Wrap a force backend, timing it and counting the pairs asked for."""
+
+    def __init__(self, backend, stats):
+        self.backend = backend
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def __call__(self, positions, masses, out=None, targets=None,
+                 **potential):
+        count = len(masses) if targets is None else len(targets)
+        self.stats.count("pairs", count * (len(masses) - 1))
+        start = time.perf_counter()
+        try:
+            return self.backend(positions, masses, out=out, targets=targets,
+                                **potential)
+        finally:
+            self.stats.add("force", time.perf_counter() - start)
+
+
+class Stats():
+    """Opt-in timers and counters of the phases of a run.
+
+    Phases are timed by wrapping the functions doing them with ``timed``,
+    so nothing is measured or slowed down while no Stats exists. Reports
+    cover the time since the previous report.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.previous = self.totals()
+
+    def add(self, phase, seconds):
+        """Account time spent in a phase."""
+        self.seconds[phase] = self.seconds.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def count(self, name, amount=1):
+        """Increase a counter."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, phase, function):
+        """Wrap function so its calls are accounted to the phase."""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return wrapper
+
+    def totals(self):
+        """Everything counted so far."""
+        return {"time": time.perf_counter(),
+                "blocks": sys.getallocatedblocks(),
+                "seconds": dict(self.seconds), "calls": dict(self.calls),
+                "counters": dict(self.counters)}
+
+    def report(self):
+        """Rates and phase shares since the previous report."""
+        now, before = self.totals(), self.previous
+        self.previous = now
+        elapsed = max(now["time"] - before["time"], 1e-9)
+
+        def change(kind, name):
+            return now[kind].get(name, 0) - before[kind].get(name, 0)
+
+        steps = change("calls", "integrate")
+        frames = change("calls", "draw")
+        result = {
+            "elapsed": elapsed,
+            "steps": steps,
+            "steps_per_s": steps / elapsed,
+            "pairs_per_s": change("counters", "pairs") / elapsed,
+            "blocks": now["blocks"] - before["blocks"],
+            "phases": {name: change("seconds", name) / elapsed
+                       for name in sorted(now["seconds"])}}
+        if frames:
+            result["frames"] = frames
+            result["frame_ms"] = elapsed / frames * 1000
+            result["dropped"] = change("counters", "dropped")
+        return result
+
+    @staticmethod
+    def lines(report):
+        """Short human readable lines of a report."""
+        lines = ["{:.0f} steps/s, {:.3g} pairs/s, {:+d} blocks".format(
+            report["steps_per_s"], report["pairs_per_s"], report["blocks"])]
+        if "frames" in report:
+            lines.append("{:.1f} ms/frame, {} dropped".format(
+                report["frame_ms"], report["dropped"]))
+        lines.append(" ".join("{} {:.0%}".format(name, share) for name, share
+                              in report["phases"].items()))
+        return lines
+
+
+@contextlib.contextmanager
+def profiling(kind, path=None):
+    """Profile the code run in the context with cProfile or pyinstrument.
+
+    The profile is printed at the end and written to path if given, as
+    pstats data for cProfile and as html for pyinstrument.
+    """
+    if kind is None:
+        yield
+        return
+    if kind == "pyinstrument":
+        import pyinstrument  # pylint: disable=import-outside-toplevel
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            print(profiler.output_text())
+            if path is not None:
+                with open(path, "w") as html_file:
+                    html_file.write(profiler.output_html())
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+class SimulationThread(threading.Thread):
+    """Run the simulation steps apart from drawing them.
+
+    After every step a snapshot of the positions and velocities, of the
+    positions of the test particles and of the current ``bodies``, is put
+    into a small queue, dropping the oldest one if the display did not keep
+    up, so the simulation never waits for the screen. ``rate`` limits the
+    steps per second, 0 runs as fast as possible.
+    """
+
+    def __init__(self, simulation_step, steps, state, rate=0, size=2,
+                 context=contextlib.nullcontext):
+        # pylint: disable=too-many-arguments
+        super().__init__(daemon=True)
+        self.simulation_step = simulation_step
+        self.steps = steps
+        self.state = state
+        self.rate = rate
+        self.context = context
+        self.snapshots = queue.Queue(size)
+        self.stopping = threading.Event()
+        self.error = None
+        self.dropped = 0
+
+    def run(self):
+        try:
+            with self.context():
+                self.simulate()
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = error
+
+    def simulate(self):
+        """Do the steps, publishing a snapshot after each."""
+        start = time.perf_counter()
+        for count, step in enumerate(self.steps):
+            if self.stopping.is_set():
+                break
+            self.simulation_step(step)
+            particles = self.state.particles
+            self.publish((step, self.state.positions.copy(),
+                          self.state.velocities.copy(),
+                          None if particles is None
+                          else particles.positions.copy(),
+                          self.state.bodies))
+            if self.rate:
+                self.stopping.wait(
+                    start + (count + 1) / self.rate - time.perf_counter())
+
+    def publish(self, snapshot):
+        """Queue a snapshot, replacing the oldest one if the queue is full."""
+        while True:
+            try:
+                self.snapshots.put_nowait(snapshot)
+                return
+            except queue.Full:
+                try:
+                    self.snapshots.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def latest(self):
+        """Most recent snapshot, or None if there is no new one."""
+        snapshot = None
+        while True:
+            try:
+                snapshot = self.snapshots.get_nowait()
+            except queue.Empty:
+                break
+        if self.error is not None:
+            raise self.error
+        return snapshot
+
+    def stop(self):
+        """Stop after the current step and wait for it."""
+        self.stopping.set()
+        self.join()
+
+
+def replay(arguments):
+    """Show a recorded binary trajectory in the pygame window.
+
+    Frames are read straight from the memory mapped file. Page up/down
+    jumps a twentieth of the recording, space pauses.
+    """
+    trajectory = Trajectory(arguments.replay)
+    state = trajectory.state()
+    canvas = Canvas()
+    canvas.trail_length = arguments.trail_length
+    canvas.trail_every = arguments.trail_every
+    screen, timer = pygameinit()
+    canvas.screen = screen
+    eventhandler = EventHandler(canvas)
+    frame = trajectory.frame_at(arguments.start)
+    speed = max(1, trajectory.header.get("interstep", arguments.interstep)
+                // trajectory.header["every"])
+    jump = max(1, len(trajectory) // 20)
+    while True:
+        state.positions[:] = trajectory.frames[frame, :, :2]
+        state.velocities[:] = trajectory.frames[frame, :, 2:]
+        draw_step(canvas, state, eventhandler)
+        timer.tick(60)
+        eventhandler.check_events()
+        if not eventhandler.paused:
+            frame += speed
+        frame += eventhandler.seek * jump
+        if eventhandler.seek and canvas.trails is not None:
+            canvas.trails.clear()
+        eventhandler.seek = 0
+        frame = min(max(frame, 0), len(trajectory) - 1)
+
+
+FRAME_PATTERN = "frame_{:06d}.png"
+
+
+def render_chunk(arguments, directory, start, stop):
+    """Render the video frames start to stop as PNG files into directory.
+
+    Runs in a pool process, drawing with the Canvas onto the screen of the
+    SDL dummy video driver. Trails are first fed the frames before start
+    and drawn whole every frame, so they continue seamlessly across
+    chunks.
+    """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    trajectory = Trajectory(arguments.replay)
+    state = trajectory.state()
+    first = trajectory.frame_at(arguments.start)
+    width, height = arguments.size
+    pygame.init()
+    canvas = Canvas()
+    canvas.screen = pygame.display.set_mode((width, height))
+    canvas.offset = Position(-width / 2, -height / 2)
+    canvas.scale_factor *= height / 800  # the view of the 800 high window
+    canvas.trail_length = arguments.trail_length
+    canvas.trail_every = arguments.trail_every
+    if canvas.trail_length > 1:
+        canvas.trails = Trails(len(state), canvas.trail_length,
+                               canvas.trail_every)
+        every = canvas.trail_every
+        for number in range(max(0, (start // every - canvas.trail_length) *
+                                every), start):
+            canvas.trails.push(trajectory.frames[
+                first + number * arguments.frame_every, :, :2])
+    for number in range(start, stop):
+        frame = first + number * arguments.frame_every
+        state.positions[:] = trajectory.frames[frame, :, :2]
+        canvas.overlay = ["{:.1f} days".format(
+            trajectory.time_of(frame) / (60 * 60 * 24))]
+        canvas.invalidate()  # whole trails, the same however chunked
+        canvas.draw(state)
+        pygame.image.save(canvas.screen, os.path.join(
+            directory, FRAME_PATTERN.format(number)))
+    pygame.quit()
+    return stop - start
+
+
+def render(arguments):
+    """Render a recorded trajectory offline, without a display.
+
+    The frames are spread in chunks over a pool of processes. An output
+    without extension is a directory of numbered PNG files, any other is
+    encoded by ffmpeg from such files at --fps.
+    """
+    trajectory = Trajectory(arguments.replay)
+    count = len(range(trajectory.frame_at(arguments.start), len(trajectory),
+                      arguments.frame_every))
+    video = os.path.splitext(arguments.render)[1] != ""
+    if video and shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg is needed to encode {}, render to a "
+                           "directory of PNG files instead".format(
+                               arguments.render))
+    chunk = max(1, -(-count // (4 * arguments.workers)))
+    with (tempfile.TemporaryDirectory() if video else
+          contextlib.nullcontext(arguments.render)) as directory:
+        os.makedirs(directory, exist_ok=True)
+        with concurrent.futures.ProcessPoolExecutor(
+                arguments.workers) as pool:
+            futures = [pool.submit(render_chunk, arguments, directory, start,
+                                   min(start + chunk, count))
+                       for start in range(0, count, chunk)]
+            with tqdm.tqdm(total=count, ascii=True, ncols=80) as progress:
+                for future in concurrent.futures.as_completed(futures):
+                    progress.update(future.result())
+        if video:
+            pixels = (["-pix_fmt", "yuv420p"] if arguments.render.endswith(
+                (".mp4", ".mov", ".mkv")) else [])
+            subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error", "-framerate",
+                 str(arguments.fps), "-i",
+                 os.path.join(directory, FRAME_PATTERN.replace(
+                     "{:06d}", "%06d")), *pixels, arguments.render],
+                check=True)
+
+
 def parse_args():
     """Use argparse."""
     parser = argparse.ArgumentParser()
@@ -519,13 +3612,147 @@ def parse_args():
                         "Number of simulation steps")
     parser.add_argument("-t", "--timestep", type=int, default=60*60*24, help=""
                         "Number of Seconds calculated in one simulation step.")
-    parser.add_argument("-i", "--interstep", type=int, default=10, help=""
-                        "Number of sub-iterations before redrawing.")
+    parser.add_argument("-i", "--interstep", type=int, default=None, help=""
+                        "Number of sub-iterations before redrawing. Defaults "
+                        "to what the integrator needs for stable orbits.")
     parser.add_argument("--hide", action="store_true", help="don't show the "
                         "screen. Useful when logging a position")
-    parser.add_argument("-l", "--logplanet", type=str, default=None, help=""
-                        "Name of a planet to be logged")
+    parser.add_argument("-l", "--logplanet", type=str, nargs="+",
+                        default=None, help="Names of the planets to be "
+                        "logged, or 'all'")
+    parser.add_argument("-o", "--output", default="simulation_out.csv",
+                        help="File the logged positions are written to.")
+    parser.add_argument("--format", choices=sorted(SINKS), default=None,
+                        help="Format of the output file. Guessed from its "
+                        "extension by default. traj logs positions and "
+                        "velocities in a binary format that can be replayed.")
+    parser.add_argument("--log-every", type=int, default=1, help="Only log "
+                        "every n-th sub-iteration.")
+    parser.add_argument("--chunk-size", type=int, default=4096, help=""
+                        "Number of logged rows kept in memory before they "
+                        "are written to the output file.")
+    parser.add_argument("--scenario", default=None, help="Json or toml "
+                        "scenario file, or a csv or npy file of bodies, "
+                        "instead of the solar system.")
+    parser.add_argument("--asteroids", type=int, default=0, help="Add this "
+                        "many asteroids on circular orbits around the most "
+                        "massive body.")
+    parser.add_argument("--belt", type=float, nargs=2, default=[2.1, 3.3],
+                        metavar=("INNER", "OUTER"), help="Inner and outer "
+                        "radius of the asteroids in AU.")
+    parser.add_argument("--asteroid-mass", type=float, default=1e15,
+                        help="Mass of each asteroid in kg, 0 to add them as "
+                        "test particles that only feel the other bodies.")
+    parser.add_argument("-b", "--backend", choices=sorted(FORCE_BACKENDS),
+                        default=PairwiseSum.name, help="Method used to "
+                        "calculate the gravitational forces.")
+    parser.add_argument("--theta", type=float, default=0.5, help="Opening "
+                        "angle of the barneshut backend. Smaller is more "
+                        "exact but slower.")
+    parser.add_argument("--integrator", choices=sorted(INTEGRATORS),
+                        default=SemiImplicitEuler.name, help="Method used "
+                        "to advance the bodies. Higher order methods allow "
+                        "larger timesteps.")
+    parser.add_argument("--tolerance", type=float, default=1e-10, help=""
+                        "Relative error per step of the rkf45 integrator.")
+    parser.add_argument("--eta", type=float, default=0.02, help="Accuracy "
+                        "of the block integrator: fraction of |a|/|da/dt| "
+                        "a body may advance in one of its steps.")
+    parser.add_argument("--max-level", type=int, default=10, help="Finest "
+                        "level of the block integrator. Its smallest step "
+                        "is timestep / 2 ** max-level.")
+    parser.add_argument("--ensemble", type=seed_range, default=None, help=""
+                        "Run one headless simulation per random seed, given "
+                        "as START:STOP or COUNT, and write a summary of each "
+                        "to ensemble_out.json.")
+    parser.add_argument("--replay", default=None, help="Show a trajectory "
+                        "recorded with --format traj instead of simulating.")
+    parser.add_argument("--start", type=int, default=0, help="Step at which "
+                        "--replay starts.")
+    parser.add_argument("--render", default=None, help="Instead of showing "
+                        "--replay, render its frames without a display into "
+                        "this directory as PNG files, or into this video "
+                        "file (like out.mp4) with ffmpeg.")
+    parser.add_argument("--size", type=int, nargs=2, default=[1200, 800],
+                        metavar=("WIDTH", "HEIGHT"), help="Size of the "
+                        "frames of --render in pixels.")
+    parser.add_argument("--fps", type=float, default=30, help="Frames per "
+                        "second of the video of --render.")
+    parser.add_argument("--frame-every", type=int, default=1, help="Render "
+                        "only every n-th recorded frame.")
+    parser.add_argument("--checkpoint", default=None, help="File to "
+                        "periodically save the simulation state to.")
+    parser.add_argument("--checkpoint-every", type=int, default=1000,
+                        help="Number of simulation steps between two "
+                        "checkpoints.")
+    parser.add_argument("--resume", default=None, help="Continue the "
+                        "simulation saved in this checkpoint. Use the same "
+                        "options as the original run.")
+    parser.add_argument("--sim-rate", type=float, default=60, help="Maximum "
+                        "simulation steps per second while showing the "
+                        "screen, 0 for as fast as possible. Drawing happens "
+                        "independently at up to 60 frames per second.")
+    parser.add_argument("--trail-length", type=int, default=0,
+                        help="Number of past positions kept per body to draw "
+                        "its orbit trail, 0 for no trails.")
+    parser.add_argument("--trail-every", type=int, default=2,
+                        help="Keep only every n-th drawn frame in the "
+                        "trails.")
+    parser.add_argument("--diagnostics-every", type=int, default=0,
+                        metavar="K", help="Measure energy, momentum and "
+                        "angular momentum every K timesteps, 0 for never.")
+    parser.add_argument("--diagnostics-out", default="diagnostics_out.csv",
+                        help="Csv file for the conserved quantities and "
+                        "their drift since the start.")
+    parser.add_argument("--max-drift", type=float, default=None,
+                        help="Largest relative drift of a conserved quantity "
+                        "before --on-drift happens.")
+    parser.add_argument("--on-drift", choices=["warn", "abort"],
+                        default="warn", help="What to do when a drift "
+                        "exceeds --max-drift.")
+    parser.add_argument("--stats", type=float, default=0,
+                        metavar="SECONDS", help="Time the phases of the run "
+                        "and count steps, pairs and frames, reporting them "
+                        "every given seconds: as a line without window, as "
+                        "an overlay in the window. 0 measures nothing.")
+    parser.add_argument("--stats-out", default=None, help="Also append "
+                        "every stats report as a line of json to this file.")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"],
+                        default=None, help="Profile the simulation steps "
+                        "and print the result at the end.")
+    parser.add_argument("--profile-out", default=None, help="Write the "
+                        "profile to this file, pstats data for cprofile and "
+                        "html for pyinstrument.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes used by --ensemble and "
+                        "the parallel backend.")
+    parser.add_argument("--encounter-distance", type=float, default=0.05,
+                        help="Distance in AU below which two bodies count "
+                        "as a close encounter.")
+    parser.add_argument("--collision-distance", type=float, default=0,
+                        help="Distance in AU below which two bodies collide, "
+                        "0 for no collisions.")
+    parser.add_argument("--merge", action="store_true", help="Merge "
+                        "colliding bodies into one, keeping their mass and "
+                        "momentum.")
+    parser.add_argument("--events-out", default=None, help="Csv file to "
+                        "write close encounters and collisions to while "
+                        "simulating. Pairs are checked after every "
+                        "sub-iteration if this or a collision distance is "
+                        "given.")
     arguments = parser.parse_args()
+    if arguments.render is not None and arguments.replay is None:
+        parser.error("--render needs a trajectory to --replay")
+    if arguments.log_every < 1:
+        parser.error("--log-every has to be at least 1")
+    extension = os.path.splitext(arguments.output)[1].lstrip(".")
+    if (arguments.logplanet and arguments.format is None and
+            extension not in SINKS):
+        parser.error("the format of {} is not known from its extension, "
+                     "choose one with --format".format(arguments.output))
+    if arguments.interstep is None:
+        arguments.interstep = INTEGRATORS[
+            arguments.integrator].default_interstep
     arguments.timestep /= arguments.interstep
     return arguments
 
@@ -538,61 +3765,165 @@ def parse_args():
 def main():
     """docstring"""
 
-    def simulation_step(current_step=0, interstep=10,
-                        log=None, timestep=86400):
+    def simulation_step(current_step=0, interstep=10, timestep=86400):
         """Do a simulation iteration."""
         for istep in range(interstep):
-            for celestial in celestials:
-                celestial.interact(celestials)
-            for celestial in celestials:
-                celestial.update(timestep)
-                if bool(log) and celestial.name == log:
-                    writer.writerow([current_step * interstep + istep,
-                                     celestial.position.x,
-                                     celestial.position.y])
-
-    def draw_step(eventhandler):
-        """Draw the current stakte to the pygame convas"""
-        for idx, celestial in enumerate(celestials):
-            canvas.place_object(celestial)
-            # if (eventhandler.followmode and
-            #         idx == eventhandler.follownum % len(celestials) - 1):
-            if eventhandler.followmode and idx == 2:
-                canvas.focus = celestials[eventhandler.follownum
-                                          % len(celestials)].position
+            advance(state, timestep)
+            if encounters is not None:
+                remap = detect(state, current_step * interstep + istep)
+                if remap is not None and trajectory is not None:
+                    trajectory.remap(remap)
+            if trajectory is not None:
+                record(current_step * interstep + istep, state)
+            if diagnostics is not None:
+                diagnostics.update(state, current_step * interstep + istep)
+        if checkpoints is not None:
+            update(current_step + 1, state, integrator, trajectory,
+                   encounters, diagnostics)
+
+    def report_stats(write):
+        """Pass the stats since the last report on, if it is time."""
+        nonlocal next_report
+        if time.perf_counter() < next_report:
+            return
+        next_report = time.perf_counter() + arguments.stats
+        report = stats.report()
+        write(Stats.lines(report))
+        if stats_file is not None:
+            stats_file.write(json.dumps(report) + "\n")
+            stats_file.flush()
 
     arguments = parse_args()
 
     # turtle.delay(0)  # pylint: disable=no-member
     # turtle.bgcolor("#000000")  # pylint: disable=no-member
-    celestials = []
-    append_planets(celestials)
-    file = io.StringIO()
-    writer = csv.writer(file, lineterminator="\n")
-    if not arguments.hide:
-        canvas = Canvas()
-        screen, timer = pygameinit()
-        canvas.screen = screen
-        eventhandler = EventHandler(canvas)
-        for step in range(arguments.duration):
-            eventhandler.check_events()
-            simulation_step(step, arguments.interstep,
-                            arguments.logplanet, arguments.timestep)
-            screen.fill(MyColor("#141414").rgb_dec())
-            draw_step(eventhandler)
-            timer.tick(60)
-            pygame.display.update()
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    exit()
+    if arguments.render is not None:
+        render(arguments)
+        return
+    if arguments.replay is not None:
+        replay(arguments)
+        return
+    if arguments.ensemble is not None:
+        run_ensemble(arguments)
+        return
+    first_step = 0
+    data = {}
+    if arguments.resume is not None:
+        state, backend, integrator, data = resume_simulation(arguments)
+        first_step = data["step"]
     else:
-        for step in tqdm.tqdm(range(arguments.duration), ascii=True, ncols=80):
-            simulation_step(step, arguments.interstep,
-                            arguments.logplanet, arguments.timestep)
-    if bool(arguments.logplanet):
-        with open("simulation_out.csv", "w") as csv_file:
-            csv_file.write(file.getvalue())
+        state, backend, integrator = create_simulation(arguments)
+    if arguments.backend == BarnesHut.name:
+        median, maximum = force_error(backend, state.positions, state.masses)
+        print("{} force error: median {:.2e}, max {:.2e}".format(
+            arguments.backend, median, maximum))
+    try:
+        trajectory = create_trajectory_writer(arguments, state,
+                                              data.get("output_offset"))
+    except KeyError as error:
+        sys.exit("--logplanet: there is no body named {}".format(error))
+    checkpoints = (None if arguments.checkpoint is None else
+                   Checkpointer(arguments.checkpoint,
+                                arguments.checkpoint_every))
+    diagnostics = None
+    if arguments.diagnostics_every:
+        diagnostics = Diagnostics(
+            state, arguments.diagnostics_every, arguments.diagnostics_out,
+            arguments.max_drift, arguments.on_drift,
+            first_step * arguments.interstep,
+            data.get("diagnostics_reference"), data.get("diagnostics_offset"),
+            integrator.forces_at)
+    encounters = None
+    if arguments.events_out is not None or arguments.collision_distance:
+        encounters = EncounterTracker(
+            state, arguments.encounter_distance * CONSTANTS.AU,
+            arguments.collision_distance * CONSTANTS.AU, arguments.merge,
+            arguments.events_out, data.get("events_offset"))
+    advance = integrator.advance
+    detect = None if encounters is None else encounters.update
+    record = None if trajectory is None else trajectory.record
+    update = None if checkpoints is None else checkpoints.update
+    draw = draw_step
+    stats = stats_file = None
+    if arguments.stats:
+        stats = Stats()
+        integrator.backend = TimedBackend(integrator.backend, stats)
+        advance = stats.timed("integrate", advance)
+        detect = detect and stats.timed("encounters", detect)
+        record = record and stats.timed("output", record)
+        update = update and stats.timed("checkpoint", update)
+        draw = stats.timed("draw", draw_step)
+        if arguments.stats_out is not None:
+            stats_file = open(arguments.stats_out, "w")
+    next_report = time.perf_counter() + arguments.stats
+    simulation = None
+    try:
+        if not arguments.hide:
+            canvas = Canvas()
+            canvas.trail_length = arguments.trail_length
+            canvas.trail_every = arguments.trail_every
+            screen, timer = pygameinit()
+            canvas.screen = screen
+            eventhandler = EventHandler(canvas)
+            display = state.copy()
+            tick = timer.tick if stats is None else stats.timed(
+                "tick", timer.tick)
+            simulation = SimulationThread(
+                lambda step: simulation_step(step, arguments.interstep,
+                                             arguments.timestep),
+                range(first_step, arguments.duration), state,
+                arguments.sim_rate,
+                context=lambda: profiling(arguments.profile,
+                                          arguments.profile_out))
+            simulation.start()
+            while True:
+                eventhandler.check_events()
+                snapshot = simulation.latest()
+                if snapshot is not None:
+                    _, positions, velocities, points, bodies = snapshot
+                    if len(positions) != len(display):  # bodies merged
+                        particles = display.particles
+                        display = SystemState(
+                            np.zeros(len(positions)), positions, velocities,
+                            bodies).copy()
+                        display.particles = particles
+                    display.positions[:] = positions
+                    display.velocities[:] = velocities
+                    if points is not None:
+                        display.particles.positions[:] = points
+                draw(canvas, display, eventhandler)
+                tick(60)
+                if stats is not None:
+                    stats.counters["dropped"] = simulation.dropped
+                    report_stats(lambda lines: setattr(
+                        canvas, "overlay", lines))
+                if trajectory is not None and not simulation.is_alive():
+                    trajectory.flush()
+        else:
+            progress = tqdm.tqdm(range(first_step, arguments.duration),
+                                 ascii=True, ncols=80)
+            with profiling(arguments.profile, arguments.profile_out):
+                for step in progress:
+                    simulation_step(step, arguments.interstep,
+                                    arguments.timestep)
+                    if stats is not None:
+                        report_stats(lambda lines: progress.write(
+                            " | ".join(lines)))
+    finally:
+        if simulation is not None:
+            simulation.stop()
+        if stats_file is not None:
+            stats_file.close()
+        if diagnostics is not None:
+            diagnostics.close()
+        if encounters is not None:
+            encounters.close()
+        if checkpoints is not None:
+            checkpoints.wait()
+        if trajectory is not None:
+            trajectory.close()
+        if isinstance(backend, ParallelSum):
+            backend.close()
 
     #
     #